@@ -1,13 +1,21 @@
-from . import plsscript
-from . import plotting
-
 # try to extract version info
 try:
   import importlib.metadata
-  __version__ = importlib.metadata.version('paperman')
+  __version__ = importlib.metadata.version('polyp')
 except:
   try:
     import pkg_resources
-    __version__ = pkg_resources.get_distribution('paperman').version
+    __version__ = pkg_resources.get_distribution('polyp').version
   except:
     __version__ = '???'
+
+from . import cache
+from . import plsscript
+from . import plotting
+from . import watch
+from . import server
+from . import build
+from . import tracing
+from . import profiling
+from . import memprofile
+from . import complexity
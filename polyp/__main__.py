@@ -7,13 +7,91 @@ import time
 import traceback
 import polyp
 import sys
+import json
 
 
-def main():
-  if '--version' in sys.argv:
+def cacheMain(argv):
+  parser = argparse.ArgumentParser(prog='polyp cache',
+                                   description='Manage the central polyp cache directory')
+  parser.add_argument('action', choices=['stats', 'prune', 'clear'],
+                      help='show cache usage, remove least recently used files '
+                           'until the size budget is met or remove all files')
+  parser.add_argument('--cache-dir', default=None,
+                      help='cache directory, defaults to $POLYP_CACHE_DIR')
+  parser.add_argument('--cache-size', default=None,
+                      help='size budget (e.g. 500M, 2G), defaults to '
+                           '$POLYP_CACHE_SIZE or 1G')
+  args = parser.parse_args(argv)
+
+  store = polyp.cache.CacheStore(args.cache_dir, args.cache_size)
+  if not store.directory:
+    parser.error('no cache directory configured, pass --cache-dir or '
+                 'set POLYP_CACHE_DIR')
+
+  if args.action == 'stats':
+    stats = store.stats()
+    print(f'directory: {stats["directory"]}')
+    print(f'entries:   {stats["entries"]}')
+    print(f'size:      {polyp.cache.formatSize(stats["size"])} of '
+          f'{polyp.cache.formatSize(stats["maxSize"])}')
+    for key in ['oldest', 'newest']:
+      if stats[key] is not None:
+        print(f'{key+":":<10} '+time.strftime('%Y-%m-%d %H:%M:%S',
+                                              time.localtime(stats[key])))
+  elif args.action == 'prune':
+    print(f'removed {store.prune()} cache files')
+  else:
+    print(f'removed {store.clear()} cache files')
+
+
+def watchedFiles(path):
+  try:
+    return polyp.cache.DependencyGraph().order(os.path.abspath(path))
+  except Exception:
+    return [os.path.abspath(path)]
+
+
+def writeCacheReport(script, args):
+  report = script.cacheReport()
+  if args.cache_stats:
+    print(report.format())
+  if args.cache_stats_json:
+    with open(args.cache_stats_json, 'w') as f:
+      json.dump(report.toDict(), f, indent=2)
+
+
+def writeComplexityStats(script, args):
+  if args.stats or args.stats_json:
+    stats = polyp.complexity.collect(script)
+    if args.stats:
+      print(polyp.complexity.formatStats(stats))
+    if args.stats_json:
+      polyp.complexity.writeJson(stats, args.stats_json)
+
+
+def main(argv=None, registry=None):
+  if argv is None:
+    argv = sys.argv[1:]
+
+  if '--version' in argv:
     print(f'polyp version {polyp.__version__}')
     return
 
+  if len(argv) > 0 and argv[0] == 'cache':
+    cacheMain(argv[1:])
+    return
+
+  if len(argv) > 0 and argv[0] == 'build':
+    sys.exit(polyp.build.buildMain(argv[1:]))
+
+  if len(argv) > 0 and argv[0] == 'serve':
+    polyp.server.serveMain(argv[1:])
+    return
+
+  if '--client' in argv:
+    argv = [a for a in argv if a != '--client']
+    sys.exit(polyp.server.clientMain(argv))
+
   parser = argparse.ArgumentParser(description='Polyp layout renderer command line tool')
   parser.add_argument('layout', type=argparse.FileType('r'),
                       help='path to a polyp layout script (*.pls) to execute '
@@ -28,8 +106,50 @@ def main():
                       help='write results as pdf file instead of gds')
   parser.add_argument('-f', '--force-rerender', action='store_true',
                       help='force rerender (including all cached .plb files)')
+  parser.add_argument('-t', '--top', default=None, metavar='NAME',
+                      help='only render and write the symbol NAME and the symbols '
+                           'it references')
+  parser.add_argument('--stream', action='store_true',
+                      help='write the gds file cell by cell without loading all '
+                           'cached cells into memory, only lowers the memory of '
+                           'builds using the cache')
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help='render imported scripts that are not cached in up to '
+                           'JOBS parallel processes')
+  parser.add_argument('--cache-dir', default=None,
+                      help='store cache files in this central directory instead '
+                           'of next to the scripts, defaults to $POLYP_CACHE_DIR')
+  parser.add_argument('--cache-size', default=None,
+                      help='size budget of the central cache directory (e.g. 500M, '
+                           '2G), defaults to $POLYP_CACHE_SIZE or 1G')
+  parser.add_argument('--cache-stats', action='store_true',
+                      help='print cache hits, misses with their reasons, '
+                           'durations and cache file sizes')
+  parser.add_argument('--cache-stats-json', default=None, metavar='FILE',
+                      help='write the cache report to FILE as json')
+  parser.add_argument('--profile', action='store_true',
+                      help='print the time spent in sections, functions and shapes '
+                           'and write collapsed stacks for flame graphs')
+  parser.add_argument('--profile-stacks', default=None, metavar='FILE',
+                      help='write the collapsed stacks of --profile to FILE instead '
+                           'of <layout>.folded')
+  parser.add_argument('--memprofile', action='store_true',
+                      help='print the peak memory and the allocation sites of '
+                           'sections and subsystems, traced with tracemalloc')
+  parser.add_argument('--memprofile-frames', type=int, default=1, metavar='N',
+                      help='number of stack frames recorded per allocation by '
+                           '--memprofile, more frames attribute allocations in '
+                           'other libraries to polyp code but are slower')
+  parser.add_argument('--stats', action='store_true',
+                      help='print polygon and vertex counts and estimated memory '
+                           'and gds sizes per cell and layer and the sections and '
+                           'shapes that created them')
+  parser.add_argument('--stats-json', default=None, metavar='FILE',
+                      help='write the statistics of --stats to FILE as json')
+  parser.add_argument('--client', action='store_true',
+                      help='let a running "polyp serve" process do the rendering')
 
-  args = parser.parse_args()
+  args = parser.parse_args(argv)
   try:
     if args.pdf:
       suffix = 'pdf'
@@ -39,37 +159,43 @@ def main():
       if args.layout.name.endswith('.gds'):
         raise ValueError('Watching only supported for *.pls files.')
       thr = False
-      parseTime = 10
       lasthash = ''
       currentLibMtl = [gdspy.current_library, False]
+      watcher = polyp.watch.Watcher()
       try:
         while True:
-          lastchange = os.stat(args.layout.name).st_mtime
+          # watch the script and all scripts it imports
+          watcher.setPaths(watchedFiles(args.layout.name))
           try:
             print('\n'*128+'------------------------------------------------------')
             print(' > Started rendering...')
             started = time.time()
             args.layout.seek(0)
-            script = polyp.plsscript.PlsScript(args.layout, args.force_rerender)
+            script = polyp.plsscript.PlsScript(args.layout, args.force_rerender,
+                                             cacheDir=args.cache_dir,
+                                             cacheSize=args.cache_size,
+                                             jobs=args.jobs, top=args.top,
+                                             registry=registry)
 
             renderTime = time.time() - started
             print(time.strftime(' > Render time: %H:%M:%S.{:03.0f}', time.gmtime(renderTime))
                                                         .format((renderTime - int(renderTime))*1e3))
+            writeCacheReport(script, args)
+            writeComplexityStats(script, args)
 
             if lasthash != script.hash:
               currentLibMtl[0] = gdspy.current_library
-              time.sleep(2)
               lasthash = script.hash
 
               if not args.no_output:
-                script.writeResults('.'.join(args.layout.name.split('.')[:-1])+'.'+suffix)
+                script.writeResults('.'.join(args.layout.name.split('.')[:-1])+'.'+suffix,
+                                    stream=args.stream)
 
               if not thr or not thr.is_alive():
                 thr = threading.Thread(target=script.openViewer, args=(currentLibMtl,))
                 thr.start()
 
               print(' > Successful.')
-              parseTime = time.time() - started
             else:
               print(' > No changes.')
 
@@ -77,30 +203,49 @@ def main():
             print(' > Error:')
             traceback.print_exc()
 
-          for _ in range(int((5+parseTime)*5)):
-            time.sleep(.2)
+          # wait for changes, stop if the viewer was closed
+          while not watcher.wait(timeout=.2):
             if thr and not thr.is_alive():
               break
-
-            if lastchange != os.stat(args.layout.name).st_mtime:
-              args.layout.close()
-              args.layout = open(args.layout.name)
-              break
-
           if thr and not thr.is_alive():
             break
+          args.layout.close()
+          args.layout = open(args.layout.name)
 
       except KeyboardInterrupt:
         pass
 
+      watcher.close()
       currentLibMtl[1] = True
       if thr and thr.is_alive():
         thr.join()
 
     else:
-      script = polyp.plsscript.PlsScript(args.layout, args.force_rerender)
-      if not args.no_output:
-        script.writeResults('.'.join(args.layout.name.split('.')[:-1])+'.'+suffix)
+      profiler = polyp.profiling.Profiler().start() if args.profile else None
+      memprofiler = (polyp.memprofile.MemoryProfiler(args.memprofile_frames).start()
+                                                  if args.memprofile else None)
+      try:
+        script = polyp.plsscript.PlsScript(args.layout, args.force_rerender,
+                                           cacheDir=args.cache_dir,
+                                           cacheSize=args.cache_size,
+                                           jobs=args.jobs, top=args.top,
+                                           registry=registry)
+        writeCacheReport(script, args)
+        writeComplexityStats(script, args)
+        if not args.no_output:
+          script.writeResults('.'.join(args.layout.name.split('.')[:-1])+'.'+suffix,
+                              stream=args.stream)
+      finally:
+        if memprofiler:
+          memprofiler.stop()
+        if profiler:
+          profiler.stop()
+      if memprofiler:
+        print(memprofiler.report())
+      if profiler:
+        print(profiler.report())
+        profiler.writeStacks(args.profile_stacks
+                             or '.'.join(args.layout.name.split('.')[:-1])+'.folded')
       if args.view:
         script.openViewer()
 
@@ -0,0 +1,163 @@
+import os as _os
+import sys as _sys
+import glob as _glob
+import time as _time
+import argparse as _argparse
+import traceback as _traceback
+import concurrent.futures as _futures
+
+from . import cache
+from . import plsscript
+
+# imported scripts stay loaded between the targets rendered by one worker
+# process of a build, see _initWorker
+_workerRegistry = None
+
+
+def expandTargets(patterns):
+  # paths of all .pls files given as file names, glob patterns or
+  # directories, in the given order and without duplicates
+  result = []
+  for pattern in patterns:
+    if _os.path.isdir(pattern):
+      paths = sorted(_glob.glob(_os.path.join(pattern, '**', '*.pls'), recursive=True))
+    elif _glob.has_magic(pattern):
+      paths = sorted(_glob.glob(pattern, recursive=True))
+      if not paths:
+        raise ValueError(f'no files match "{pattern}"')
+    else:
+      paths = [pattern]
+    for path in paths:
+      if _os.path.abspath(path) not in [_os.path.abspath(p) for p in result]:
+        result.append(path)
+  return result
+
+
+def outputPath(path, suffix):
+  return '.'.join(path.split('.')[:-1])+'.'+suffix
+
+
+def _initWorker():
+  global _workerRegistry
+  _workerRegistry = plsscript.ImportRegistry()
+
+
+def _render(args, registry=None):
+  # renders one script and writes its results if output is given, errors
+  # are returned instead of raised so that other targets are unaffected
+  path, output, options, fresh = args
+  registry = registry or _workerRegistry
+  # every target is a new run of the registry, imports that were rendered
+  # for earlier targets are not rendered again if rerendering is forced
+  registry.begin(registry.fresh | set(fresh))
+  started = _time.perf_counter()
+  try:
+    script = plsscript.PlsScript(open(path, 'r'),
+                                 options['forceRerender'] and path not in registry.fresh,
+                                 cacheDir=options['cacheDir'],
+                                 cacheSize=options['cacheSize'],
+                                 top=options['top'], registry=registry)
+    if output:
+      script.writeResults(output, stream=options['stream'])
+    error = None
+  except Exception as e:
+    error = (f'{type(e).__name__}: {e}', _traceback.format_exc())
+  registry.fresh.update(registry.currentPaths())
+  return error, _time.perf_counter() - started
+
+
+def build(targets, jobs=1, suffix='gds', noOutput=False, forceRerender=False,
+          cacheDir=None, cacheSize=None, top=None, stream=False):
+  # renders all targets and returns (path, error, duration) for each of
+  # them in the order of targets. With jobs > 1 the uncached imports of
+  # all targets are rendered first in waves of a process pool, so that
+  # libraries shared by many targets are rendered only once.
+  options = {'forceRerender': forceRerender, 'cacheDir': cacheDir,
+             'cacheSize': cacheSize, 'top': top, 'stream': stream}
+  paths = [_os.path.abspath(t) for t in targets]
+  tasks = [(path, None if noOutput else outputPath(path, suffix), options, ())
+              for path in paths]
+  if jobs <= 1:
+    registry = plsscript.ImportRegistry()
+    return [(t, *_render(task, registry)) for t, task in zip(targets, tasks)]
+
+  graph = cache.DependencyGraph()
+  store = cache.CacheStore(cacheDir, cacheSize)
+  imports = []
+  for path in paths:
+    try:
+      imports.extend([p for p in graph.order(path)[:-1] if p not in imports])
+    except Exception:
+      # reported when the target itself is rendered
+      pass
+  pending = [path for path in imports
+                if forceRerender
+                   or not store.isCached(store.scriptPath(path, graph.key(path)),
+                                         graph.key(path))]
+  fresh = set()
+  with _futures.ProcessPoolExecutor(jobs, initializer=_initWorker) as pool:
+    while pending:
+      wave = [path for path in pending
+                if all([importPath not in pending
+                            for _, importPath in graph.add(path)])]
+      list(pool.map(_render, [(path, None, options, sorted(fresh)) for path in wave]))
+      fresh.update(wave)
+      pending = [path for path in pending if path not in wave]
+
+    tasks = [(path, output, options, sorted(fresh)) for path, output, _, _ in tasks]
+    return [(t, *result) for t, result in zip(targets, pool.map(_render, tasks))]
+
+
+def buildMain(argv):
+  parser = _argparse.ArgumentParser(prog='polyp build',
+                                    description='Render many polyp layout scripts')
+  parser.add_argument('targets', nargs='+',
+                      help='layout scripts (*.pls), glob patterns or directories '
+                           'that are searched for layout scripts')
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help='render up to JOBS scripts in parallel processes')
+  parser.add_argument('-n', '--no-output', action='store_true',
+                      help='do not write results to file')
+  parser.add_argument('-p', '--pdf', action='store_true',
+                      help='write results as pdf file instead of gds')
+  parser.add_argument('-f', '--force-rerender', action='store_true',
+                      help='force rerender (including all cached .plb files)')
+  parser.add_argument('-t', '--top', default=None, metavar='NAME',
+                      help='only render and write the symbol NAME and the symbols '
+                           'it references')
+  parser.add_argument('--stream', action='store_true',
+                      help='write gds files cell by cell without loading all '
+                           'cached cells into memory, only lowers the memory of '
+                           'targets using the cache')
+  parser.add_argument('--traceback', action='store_true',
+                      help='print the full traceback of failed targets')
+  parser.add_argument('--cache-dir', default=None,
+                      help='central cache directory, defaults to $POLYP_CACHE_DIR')
+  parser.add_argument('--cache-size', default=None,
+                      help='size budget of the central cache directory, defaults '
+                           'to $POLYP_CACHE_SIZE or 1G')
+  args = parser.parse_args(argv)
+
+  try:
+    targets = expandTargets(args.targets)
+  except ValueError as e:
+    parser.error(str(e))
+
+  started = _time.perf_counter()
+  results = build(targets, jobs=args.jobs, suffix='pdf' if args.pdf else 'gds',
+                  noOutput=args.no_output, forceRerender=args.force_rerender,
+                  cacheDir=args.cache_dir, cacheSize=args.cache_size,
+                  top=args.top, stream=args.stream)
+
+  failed = 0
+  for target, error, duration in results:
+    if error is None:
+      print(f'  ok      {target} ({cache.formatDuration(duration)})')
+    else:
+      failed += 1
+      print(f'  FAILED  {target}: {error[0]}')
+      if args.traceback:
+        print(error[1], file=_sys.stderr)
+  print(f'{len(results)} scripts rendered in '
+        f'{cache.formatDuration(_time.perf_counter()-started)}, {failed} failed')
+  return 1 if failed else 0
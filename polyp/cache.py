@@ -0,0 +1,667 @@
+import re as _re
+import os as _os
+import hashlib as _hashlib
+import json as _json
+import tempfile as _tempfile
+import time as _time
+import mmap as _mmap
+import struct as _struct
+import numpy as _np
+import gdspy as _gdspy
+
+from . import __version__
+from . import utils
+
+# increase whenever the content of .plb files changes incompatibly
+FORMAT_VERSION = 6
+
+# .plb files start with this magic, followed by the length of a json
+# metadata header, the header itself and the raw data of all numpy
+# arrays listed in the header, each aligned to _ALIGN bytes. Cache files
+# may be written by other users, so they only contain plain data and
+# reading them cannot execute code.
+_MAGIC = b'POLYPLJ\n'
+_ALIGN = 64
+# kinds of numpy arrays in cache files: bool, int, unsigned and float
+_ARRAY_KINDS = 'biuf'
+
+# size budget of a central cache directory if none is configured
+DEFAULT_MAX_SIZE = 2**30
+
+# cache files get the permissions of regular files instead of the 0o600
+# of temporary files, the umask can only be read by setting it
+_UMASK = _os.umask(0)
+_os.umask(_UMASK)
+
+
+def cachePath(path):
+  if not path:
+    return ''
+  base, fname = _os.path.split(path)
+  fname = '.'.join(fname.split('.')[:-1])
+  return _os.path.join(base, '.'+fname+'.plb')
+
+
+def sectionCachePath(path):
+  if not path:
+    return ''
+  return cachePath(path)[:-len('.plb')]+'.sections.plb'
+
+
+def versionKey():
+  return f'polyp {__version__}, cache format {FORMAT_VERSION}'
+
+
+def hashParts(*parts):
+  h = _hashlib.sha1()
+  h.update((versionKey()+'\n').encode())
+  for part in parts:
+    h.update((str(part)+'\n').encode())
+  return h.hexdigest()
+
+
+def normalizeText(text):
+  return '\n'.join([line.rstrip() for line in text.split('\n')
+                                        if line.strip()])
+
+
+def importedFiles(text):
+  return [m.group(1) for m in _re.finditer(r"IMPORT[ \t]+(\S+)", text)]
+
+
+class DependencyGraph:
+  # import graph of all scripts used in one run. Every file is read and
+  # hashed only once, even if it is imported along several paths, the
+  # keys of all files are computed in topological order. The key of a
+  # file covers its own text, the keys of all imported scripts, the
+  # polyp version and all options that change the rendered result, but
+  # no file timestamps.
+  def __init__(self, options={}):
+    self.options = options
+    self._texts = {}
+    self._imports = {}
+    self._keys = {}
+    self._fileHashes = {}
+
+  def add(self, path, text=None):
+    # adds the file and all files it imports, returns the import paths
+    # of the file
+    if path in self._imports:
+      return self._imports[path]
+    stack = [(path, text)]
+    visiting = []
+    while stack:
+      current, currentText = stack[-1]
+      if current in self._imports:
+        stack.pop()
+        continue
+      if current not in self._texts:
+        if currentText is None:
+          with open(current, 'r') as f:
+            currentText = utils.readScript(f)
+        self._texts[current] = normalizeText(currentText)
+        visiting.append(current)
+      pending = []
+      for importFile in importedFiles(self._texts[current]):
+        importPath = _os.path.join(_os.path.dirname(current), importFile)
+        if importPath.endswith('.pls'):
+          importPath = _os.path.abspath(importPath)
+          if importPath in visiting:
+            raise ValueError('circular IMPORT of '+_os.path.basename(importPath))
+          if importPath not in self._imports:
+            pending.append((importPath, None))
+      if pending:
+        stack.extend(pending)
+      else:
+        self._imports[current] = [
+              (importFile, _os.path.abspath(_os.path.join(_os.path.dirname(current),
+                                                          importFile)))
+                  for importFile in importedFiles(self._texts[current])
+                      if importFile.endswith('.pls')]
+        visiting.remove(current)
+        stack.pop()
+    return self._imports[path]
+
+  def order(self, path):
+    # path and all its transitive imports, imports before importers
+    result = []
+    stack = [(path, False)]
+    while stack:
+      current, done = stack.pop()
+      if done:
+        if current not in result:
+          result.append(current)
+      elif current not in result:
+        stack.append((current, True))
+        for _, importPath in reversed(self.add(current)):
+          stack.append((importPath, False))
+    return result
+
+  def key(self, path, text=None):
+    self.add(path, text)
+    for current in self.order(path):
+      if current not in self._keys:
+        h = _hashlib.sha1()
+        h.update((versionKey()+'\n').encode())
+        h.update((repr(sorted(self.options.items()))+'\n').encode())
+        h.update((self._texts[current]+'\n').encode())
+        for importFile, importPath in self._imports[current]:
+          h.update((importFile+':'+self._keys[importPath]+'\n').encode())
+        self._keys[current] = h.hexdigest()
+    return self._keys[path]
+
+  def files(self, path):
+    # text hashes of path and all files it imports
+    result = {}
+    for current in self.order(path):
+      if current not in self._fileHashes:
+        self._fileHashes[current] = hashParts(self._texts[current])
+      result[current] = self._fileHashes[current]
+    return result
+
+
+def parseSize(size):
+  if size is None or type(size) is int:
+    return size
+  m = _re.match(r"\s*([0-9.]+)\s*([kKmMgGtT]?)i?[bB]?\s*$", size)
+  if not m:
+    raise ValueError('Invalid cache size "'+size+'", expected e.g. "500M" or "2G".')
+  return int(float(m.group(1))*1024**('.kmgt'.index(m.group(2).lower() or '.')))
+
+
+def _aligned(n):
+  return -(-n//_ALIGN)*_ALIGN
+
+
+def toJson(obj):
+  # plain data as json, tuples and dicts with other than string keys,
+  # e.g. layer numbers, are tagged to restore them in fromJson
+  if obj is None or type(obj) in (bool, int, float, str):
+    return obj
+  if isinstance(obj, (_np.bool_, _np.integer, _np.floating, _np.str_)):
+    return obj.item()
+  if type(obj) is list:
+    return [toJson(v) for v in obj]
+  if type(obj) is tuple:
+    return {'$tuple': [toJson(v) for v in obj]}
+  if type(obj) is dict:
+    if all([type(k) is str and not k.startswith('$') for k in obj]):
+      return {k: toJson(v) for k, v in obj.items()}
+    return {'$items': [[toJson(k), toJson(v)] for k, v in obj.items()]}
+  raise ValueError(type(obj).__name__+' cannot be stored in cache files')
+
+
+def fromJson(obj):
+  # object hook of json.loads
+  if len(obj) == 1 and '$tuple' in obj:
+    return tuple(obj['$tuple'])
+  if len(obj) == 1 and '$items' in obj:
+    return {k: v for k, v in obj['$items']}
+  return obj
+
+
+def writeFile(f, key, header, arrays={}):
+  arrays = {name: _np.ascontiguousarray(arr) for name, arr in arrays.items()}
+  for arr in arrays.values():
+    if arr.dtype.kind not in _ARRAY_KINDS:
+      raise ValueError(f'arrays of type {arr.dtype} cannot be stored in cache files')
+  table = {}
+  offset = 0
+  for name, arr in arrays.items():
+    table[name] = [offset, arr.dtype.str, list(arr.shape)]
+    offset += _aligned(arr.nbytes)
+  meta = _json.dumps(toJson({'key': key, 'arrays': table, 'header': header}),
+                     separators=(',', ':')).encode()
+  f.write(_MAGIC+_struct.pack('<Q', len(meta))+meta)
+  f.write(b'\0'*(_aligned(len(_MAGIC)+8+len(meta))-len(_MAGIC)-8-len(meta)))
+  for arr in arrays.values():
+    f.write(arr.tobytes())
+    f.write(b'\0'*(_aligned(arr.nbytes)-arr.nbytes))
+
+
+def readFile(f, key):
+  # returns (header, arrays) or None if the file was created for a
+  # different key or format, arrays are read-only views of the
+  # memory-mapped file. Raises a ValueError for damaged files.
+  if f.read(len(_MAGIC)) != _MAGIC:
+    return None
+  size = _os.fstat(f.fileno()).st_size
+  n, = _struct.unpack('<Q', f.read(8))
+  if len(_MAGIC)+8+n > size:
+    raise ValueError('invalid cache file header')
+  try:
+    meta = _json.loads(f.read(n), object_hook=fromJson)
+  except ValueError:
+    raise ValueError('invalid cache file header')
+  if type(meta) is not dict or meta.get('key') != key:
+    return None
+
+  arrays = {}
+  if meta['arrays']:
+    try:
+      buf = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ)
+    except (ValueError, OSError):
+      f.seek(0)
+      buf = f.read()
+    dataStart = _aligned(len(_MAGIC)+8+n)
+    for name, (offset, dtype, shape) in meta['arrays'].items():
+      dtype = _np.dtype(dtype)
+      count = int(_np.prod(shape))
+      if (dtype.kind not in _ARRAY_KINDS or offset < 0 or count < 0
+            or dataStart+offset+count*dtype.itemsize > len(buf)):
+        raise ValueError('invalid array '+name+' in cache file')
+      if count:
+        arrays[name] = _np.frombuffer(buf, dtype, count,
+                                      dataStart+offset).reshape(shape)
+      else:
+        arrays[name] = _np.zeros(shape, dtype)
+  return meta['header'], arrays
+
+
+class PolygonPacker:
+  # collects polygons of many cells or sections in few contiguous arrays
+  def __init__(self):
+    self._polygons = []
+    self._layers = []
+    self._datatypes = []
+
+  def add(self, polygons, layers, datatypes):
+    start = len(self._polygons)
+    self._polygons.extend(polygons)
+    self._layers.extend(layers)
+    self._datatypes.extend(datatypes)
+    return (start, len(self._polygons))
+
+  def arrays(self):
+    lengths = [len(p) for p in self._polygons]
+    return {'points': (_np.concatenate(self._polygons).astype(_np.float64)
+                            if self._polygons else _np.zeros((0, 2))),
+            'offsets': _np.cumsum([0]+lengths, dtype=_np.int64),
+            'layers': _np.array(self._layers, dtype=_np.int32),
+            'datatypes': _np.array(self._datatypes, dtype=_np.int32)}
+
+
+class PackedPolygons:
+  def __init__(self, arrays):
+    self._points = arrays.get('points')
+    self._offsets = arrays.get('offsets')
+    self._layers = arrays.get('layers')
+    self._datatypes = arrays.get('datatypes')
+
+  def get(self, start, stop):
+    offsets = self._offsets[start:stop+1].tolist()
+    return ([self._points[a:b] for a, b in zip(offsets[:-1], offsets[1:])],
+            self._layers[start:stop].tolist(),
+            self._datatypes[start:stop].tolist())
+
+  def polygonSet(self, start, stop):
+    # the polygons keep referencing the mapped file instead of copying
+    # it like the PolygonSet constructor does
+    polygonSet = _gdspy.PolygonSet.__new__(_gdspy.PolygonSet)
+    polygonSet.polygons, polygonSet.layers, polygonSet.datatypes = self.get(start, stop)
+    polygonSet.properties = {}
+    return polygonSet
+
+
+def packPolygonSets(polygonSets, packer):
+  polygons, layers, datatypes = [], [], []
+  for polygonSet in polygonSets:
+    polygons.extend(polygonSet.polygons)
+    layers.extend(polygonSet.layers)
+    datatypes.extend(polygonSet.datatypes)
+  return packer.add(polygons, layers, datatypes)
+
+
+def packLabel(label):
+  return {'text': label.text,
+          'position': tuple(label.position),
+          'anchor': label.anchor,
+          'rotation': label.rotation,
+          'magnification': label.magnification,
+          'x_reflection': label.x_reflection,
+          'layer': label.layer,
+          'texttype': label.texttype,
+          'properties': label.properties}
+
+
+def unpackLabel(meta):
+  label = _gdspy.Label(meta['text'], meta['position'], rotation=meta['rotation'],
+                       magnification=meta['magnification'],
+                       x_reflection=meta['x_reflection'], layer=meta['layer'],
+                       texttype=meta['texttype'])
+  label.anchor = meta['anchor']
+  label.properties = meta['properties']
+  return label
+
+
+def packCells(libCells, packer):
+  cells = {}
+  for name, cell in libCells.items():
+    polygonSets = list(cell.polygons)
+    for path in cell.paths:
+      polygonSets.append(path.to_polygonset())
+    references = []
+    for ref in cell.references:
+      refName = ref.ref_cell.name if isinstance(ref.ref_cell, _gdspy.Cell) else ref.ref_cell
+      references.append({'cell': refName,
+                         'origin': tuple(ref.origin),
+                         'rotation': ref.rotation,
+                         'magnification': ref.magnification,
+                         'x_reflection': ref.x_reflection,
+                         'array': ((ref.columns, ref.rows, tuple(ref.spacing))
+                                      if isinstance(ref, _gdspy.CellArray) else None)})
+    cells[name] = {'polygons': packPolygonSets([p for p in polygonSets if p is not None],
+                                               packer),
+                   'references': references,
+                   'labels': [packLabel(label) for label in cell.labels]}
+  return cells
+
+
+def unpackCell(name, meta, packed, getCell):
+  cell = _gdspy.Cell(name, exclude_from_current=True)
+  start, stop = meta['polygons']
+  if stop > start:
+    cell.add(packed.polygonSet(start, stop))
+  for label in meta['labels']:
+    cell.add(unpackLabel(label))
+  for ref in meta['references']:
+    refCell = getCell(ref['cell'])
+    if ref['array'] is None:
+      cell.add(_gdspy.CellReference(refCell, ref['origin'], ref['rotation'],
+                                    ref['magnification'], ref['x_reflection'],
+                                    ignore_missing=True))
+    else:
+      columns, rows, spacing = ref['array']
+      cell.add(_gdspy.CellArray(refCell, columns, rows, spacing, ref['origin'],
+                                ref['rotation'], ref['magnification'],
+                                ref['x_reflection'], ignore_missing=True))
+  return cell
+
+
+def unpackCells(cells, packed, lib):
+  # cells are only unpacked when they are accessed for the first time,
+  # unpacking a cell also unpacks all cells it references
+  getCell = lambda name: lib.cells[name] if name in lib.cells else name
+  for name in cells:
+    lib.cells.setLazy(name, lambda name=name: unpackCell(name, cells[name],
+                                                         packed, getCell))
+
+
+def missReasons(oldFiles, files):
+  # describes which of the files changed since the text hashes oldFiles
+  # were recorded
+  if oldFiles is None:
+    return ['no previous build recorded']
+  reasons = []
+  for path, fileHash in files.items():
+    if path not in oldFiles:
+      reasons.append('new dependency '+path)
+    elif oldFiles[path] != fileHash:
+      reasons.append('changed '+path)
+  for path in oldFiles:
+    if path not in files:
+      reasons.append('removed dependency '+path)
+  return reasons
+
+
+class SectionCache:
+  # results of individual sections of the last build, also remembers the
+  # text hashes of all files involved in that build
+  def __init__(self, index={}, arrays={}, files=None):
+    self._index = index
+    self._packed = PackedPolygons(arrays)
+    self._extra = {}
+    self.files = files
+
+  def __contains__(self, key):
+    return key in self._index or key in self._extra
+
+  def __getitem__(self, key):
+    if key in self._extra:
+      return self._extra[key]
+    polygons, _, datatypes = self._packed.get(*self._index[key])
+    return polygons, datatypes
+
+  def update(self, results):
+    # adds (polygons, datatypes) results of sections by key
+    self._extra.update(results)
+
+
+def formatSize(size):
+  for unit in ['B', 'KiB', 'MiB', 'GiB']:
+    if size < 1024:
+      break
+    size /= 1024
+  else:
+    unit = 'TiB'
+  return f'{size:.1f} {unit}' if unit != 'B' else f'{size} B'
+
+
+def formatDuration(seconds):
+  if seconds < 1:
+    return f'{seconds*1e3:.1f} ms'
+  return f'{seconds:.2f} s'
+
+
+class CacheReport:
+  # collects what happened with the cache of every script loaded or
+  # rendered with one CacheStore, durations of a script include the
+  # durations of the scripts it imports
+  def __init__(self):
+    self.scripts = []
+
+  def add(self, path, cacheFile):
+    entry = {'script': path,
+             'cacheFile': cacheFile,
+             'result': None,
+             'reasons': [],
+             'validateTime': 0.,
+             'loadTime': 0.,
+             'renderTime': 0.,
+             'storeTime': 0.,
+             'size': None,
+             'sectionHits': 0,
+             'sectionMisses': 0}
+    self.scripts.append(entry)
+    return entry
+
+  def summary(self):
+    # scripts reused from an earlier run of the same process count as hits
+    results = ['hit' if e['result'] == 'reused' else e['result'] for e in self.scripts]
+    return {'hits': results.count('hit'),
+            'misses': len(results)-results.count('hit'),
+            'sectionHits': sum([e['sectionHits'] for e in self.scripts]),
+            'sectionMisses': sum([e['sectionMisses'] for e in self.scripts]),
+            'size': sum([e['size'] or 0 for e in self.scripts])}
+
+  def toDict(self):
+    return {'scripts': self.scripts, 'summary': self.summary()}
+
+  def format(self):
+    summary = self.summary()
+    lines = [f'cache: {summary["hits"]} hits, {summary["misses"]} misses, '
+             f'sections: {summary["sectionHits"]} hits, '
+             f'{summary["sectionMisses"]} misses']
+    for e in self.scripts:
+      times = [f'{name} {formatDuration(e[name+"Time"])}'
+                    for name in ['validate', 'load', 'render', 'store']
+                        if e[name+'Time']]
+      lines.append(f'  {e["result"]:<6} {_os.path.relpath(e["script"])}'
+                   +(f' ({formatSize(e["size"])})' if e['size'] is not None else '')
+                   +': '+', '.join(times))
+      for reason in e['reasons']:
+        lines.append(f'           {reason}')
+    return '\n'.join(lines)
+
+
+class CacheStore:
+  # Without a directory, cache files are placed next to the scripts
+  # (.<name>.plb). With a directory, all cache files are collected in
+  # there, named by their content key, and the directory is kept below
+  # a size budget by removing the least recently used files.
+  def __init__(self, directory=None, maxSize=None):
+    if directory is None:
+      directory = _os.environ.get('POLYP_CACHE_DIR') or None
+    if maxSize is None:
+      maxSize = _os.environ.get('POLYP_CACHE_SIZE') or None
+    self.directory = directory and _os.path.abspath(_os.path.expanduser(directory))
+    self.maxSize = parseSize(maxSize)
+    if self.directory and self.maxSize is None:
+      self.maxSize = DEFAULT_MAX_SIZE
+    self.report = CacheReport()
+    # approximate size of the directory, it is only pruned when this
+    # exceeds the size budget
+    self._size = None
+
+  def scriptPath(self, path, key):
+    if not path:
+      return ''
+    if self.directory:
+      return _os.path.join(self.directory, key+'.plb')
+    return cachePath(path)
+
+  def sectionsPath(self, path):
+    # the section cache of a script has to be found after the script was
+    # edited, so in a central directory it is named by the script path
+    # and not shared between checkouts
+    if not path:
+      return ''
+    if self.directory:
+      name = _hashlib.sha1(_os.path.abspath(path).encode()).hexdigest()
+      return _os.path.join(self.directory, name+'.sections.plb')
+    return sectionCachePath(path)
+
+  def load(self, path, key):
+    # returns (header, arrays) or None if the cache file does not exist
+    # or was created for a different key
+    try:
+      f = open(path, 'rb')
+    except FileNotFoundError:
+      return None
+    with f:
+      result = readFile(f, key)
+    if result is not None and self.directory:
+      # mark as recently used
+      try:
+        _os.utime(path)
+      except OSError:
+        pass
+    return result
+
+  def isCached(self, path, key):
+    try:
+      with open(path, 'rb') as f:
+        return readFile(f, key) is not None
+    except Exception:
+      return False
+
+  def loadSections(self, path):
+    try:
+      result = self.load(path, versionKey())
+    except:
+      utils.debug('loading '+_os.path.basename(path)+' failed.')
+      result = None
+    if result is None:
+      return SectionCache()
+    header, arrays = result
+    return SectionCache(header['index'], arrays, header['files'])
+
+  def storeSections(self, path, sections, files={}):
+    packer = PolygonPacker()
+    index = {key: packer.add(polygons, [0]*len(polygons), datatypes)
+                          for key, (polygons, datatypes) in sections.items()}
+    self.store(path, versionKey(), {'index': index, 'files': files},
+               packer.arrays())
+
+  def store(self, path, key, header, arrays={}):
+    # write to a temporary file first and rename afterwards, so that
+    # concurrent processes never see partially written cache files
+    directory = _os.path.dirname(path)
+    if self.directory:
+      _os.makedirs(directory, exist_ok=True)
+    fd, tmpPath = _tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    try:
+      _os.chmod(tmpPath, 0o666 & ~_UMASK)
+      with _os.fdopen(fd, 'wb') as f:
+        writeFile(f, key, header, arrays)
+        size = f.tell()
+      _os.replace(tmpPath, path)
+    except:
+      _os.remove(tmpPath)
+      raise
+    if self.directory:
+      if self._size is None:
+        self._size = sum([size for _, size, _ in self.entries()])
+      else:
+        self._size += size
+      if self._size > self.maxSize:
+        self.prune(keep=[path])
+
+  def entries(self):
+    result = []
+    if not self.directory or not _os.path.isdir(self.directory):
+      return result
+    for fname in _os.listdir(self.directory):
+      path = _os.path.join(self.directory, fname)
+      if fname.endswith('.plb'):
+        try:
+          st = _os.stat(path)
+        except FileNotFoundError:
+          continue
+        result.append((path, st.st_size, st.st_mtime))
+    return sorted(result, key=lambda e: e[2])
+
+  def stats(self):
+    entries = self.entries()
+    return {'directory': self.directory,
+            'maxSize': self.maxSize,
+            'entries': len(entries),
+            'size': sum([size for _, size, _ in entries]),
+            'oldest': entries[0][2] if entries else None,
+            'newest': entries[-1][2] if entries else None}
+
+  def prune(self, maxSize=None, keep=[]):
+    # remove least recently used files until the size budget is met,
+    # returns the number of removed files
+    maxSize = parseSize(maxSize)
+    if maxSize is None:
+      maxSize = self.maxSize
+    if not self.directory or not _os.path.isdir(self.directory):
+      return 0
+
+    # temporary files of crashed processes
+    for fname in _os.listdir(self.directory):
+      path = _os.path.join(self.directory, fname)
+      try:
+        if fname.endswith('.tmp') and _os.path.getmtime(path) < _time.time()-3600:
+          _os.remove(path)
+      except OSError:
+        pass
+
+    removed = 0
+    entries = self.entries()
+    total = sum([size for _, size, _ in entries])
+    for path, size, _ in entries:
+      if total <= maxSize:
+        break
+      if path in keep:
+        continue
+      try:
+        _os.remove(path)
+        removed += 1
+      except FileNotFoundError:
+        pass
+      total -= size
+    self._size = total
+    return removed
+
+  def clear(self):
+    self._size = None
+    removed = 0
+    for path, _, _ in self.entries():
+      try:
+        _os.remove(path)
+        removed += 1
+      except FileNotFoundError:
+        pass
+    return removed
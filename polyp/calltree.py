@@ -10,6 +10,12 @@ from . import geometry
 
 _PRINT_LIT_REDUCTION = False
 
+# functions and operators that are evaluated element-wise for numpy arrays,
+# see CallTree.vectorize
+_VECTOR_FUNCS = ['', 'abs', 'sqrt', 'sin', 'cos', 'tan', 'asin', 'acos',
+                 'atan', 'atan2']
+_VECTOR_OPERATORS = ['^', '*', '/', '+', '-', 'pstart', 'psep', 'pend', '=', ',']
+
 class CallTree:
   _operators = [['make'], ['.'], ['^'], ['*', '/'], ['-', '+'],
                 ['pstart', 'pend'], ['psep'], ['.'],
@@ -164,7 +170,7 @@ class CallTree:
     return tree.getShape()
 
 
-  def evaluate(self, resolveGlobals=False):
+  def _reduceArguments(self, resolveGlobals=False):
     for child in self._children:
       if type(child) is CallTree:
         child.evaluate(resolveGlobals=resolveGlobals)
@@ -188,6 +194,10 @@ class CallTree:
     self.resolveNames({}, resolveGlobals=resolveGlobals)
     self._reduceLiterals()
 
+
+  def evaluate(self, resolveGlobals=False):
+    self._reduceArguments(resolveGlobals)
+
     #=====================================================================
     # prepare function parsing
     if self._func == "":
@@ -357,7 +367,7 @@ class CallTree:
       # square root
       elif self._func == "sqrt":
         requireResolvedNamesOnly()
-        if len(dargs) > 0 or len(largs) != 1 or largs[0]<0:
+        if len(dargs) > 0 or len(largs) != 1 or _np.min(largs[0]) < 0:
           raise ValueError("Invalid arguments to 'sqrt' call.")
         self._literals = [['float', _np.sqrt(largs[0])]]
 
@@ -369,7 +379,7 @@ class CallTree:
           raise ValueError("Invalid arguments to 'cos' function.")
         u = dargs.get('unit', 'deg')
         if u == 'deg':
-          largs[0] *= _np.pi/180
+          largs[0] = largs[0]*_np.pi/180
         elif u == 'rad':
           pass
         else:
@@ -451,17 +461,7 @@ class CallTree:
                                _gdspy.CellReference(
                                     self._root.gdsLib.cells[largs[0]])]]
         elif len(largs) > 0 or len(dargs) > 0:
-          for candidateName, candidate in self._root.paramSymDict.items():
-            _cmp = lambda s: _re.sub(r'[\-_\{\}]+', '', s.lower())
-            if _cmp(candidateName) == _cmp(largs[0]):
-              utils.debug(f'matched {largs[0]} with {candidateName}')
-              paramSym = candidate
-              break
-          else:
-            raise ValueError('tried to create reference to undefined '
-                             'parametric symbol "'+str(largs[0])+'" '
-                             '(symbols may only be used after '
-                             'their definition)')
+          paramSym = self._root.paramSymbol(largs[0])
 
           listParams = [list(v) for v in zip(largTypes[1:], largs[1:])]
           self._literals = [['paramshaperef', paramSym], ['operator', 'make'],
@@ -840,7 +840,17 @@ class CallTree:
             if viewNextLit()[1].check(viewPrevLit()):
               op1 = popPrevLit()
               op2 = popNextLit()
-              literals[i] = op2[1](op1)
+              result = op2[1](op1)
+              # sweeps with ref=True result in several references
+              if type(result[0]) is list:
+                if (i < len(literals) - 1 and literals[i+1][0] == 'operator'
+                      or i > 0 and literals[i-1][0] == 'operator'):
+                  raise ValueError("References of a sweep with 'ref=True' cannot "
+                                   "be transformed or combined with other "
+                                   "operators.")
+                literals[i:i+1] = result
+              else:
+                literals[i] = result
 
           #=====================================================================
           # argument list operator
@@ -912,31 +922,7 @@ class CallTree:
                                f'in argument list '
                                f'of parametric symbol {pattern}')
 
-            # create symbol name
-            def removeLitTypes(params):
-              res = []
-              for p in params:
-                if p[0] == 'obj':
-                  res.append('_'.join([f'{k}{v[1]}' for k, v in p[1].items()]))
-                else:
-                  res.append(p[1])
-              return res
-
-            # format and clean symbol name
-            symInstanceName = (_re.sub(
-                                    r'[^a-zA-Z0-9\._]+', ' ',
-                                    pattern.format(
-                                        *removeLitTypes(usedParams)))
-                                  .strip().replace(' ', '_'))
-
-            # check if different than pattern to validate that placeholders
-            # existed in the original name
-            if pattern == symInstanceName:
-              raise ValueError(f'parametric symbol name {pattern} does not '
-                                'seem to contain {} placeholders, please '
-                               f'insert placeholders to guarantee unique '
-                               f'symbol names for each parameter choice')
-
+            symInstanceName = utils.symbolInstanceName(pattern, usedParams)
             if symInstanceName in self._root.gdsLib.cells.keys():
               sym = self._root.gdsLib.cells[symInstanceName]
             else:
@@ -946,57 +932,8 @@ class CallTree:
 
             # if the newly added symbol is still empty, create geometry
             if len(list(sym)) == 0:
-              for section in paramSym:
-                tree = _copy.deepcopy(section['tree'])
-                # replace root reference with true reference:
-                tree._root = section['tree']._root
-
-                layer = section['layer']
-                argNames = section['args']
-                unresolvedNames = tree.resolveNames(argdict)
-                tree.evaluate(resolveGlobals=True)
-                if tree._result[0] != 'none':
-                  shapeResult = False
-                  try:
-                    s = tree.getShape()
-                    shapeResult = True
-                  except ValueError:
-                    refs = tree.getShaperef()
-                  if shapeResult:
-                    if s is None:
-                      if unresolvedNames:
-                        raise ValueError('unresolved name(s) in layer shapes: '
-                                              +', '.join(['"'+n+'"'
-                                                  for n in unresolvedNames]))
-                      else:
-                        raise ValueError('unexpected None-shape found '
-                                         'after instanciation '
-                                         'of parametric symbol:\n'+str(tree))
-
-                    shape = s._shape
-                    if not shape is None:
-                      if hasattr(shape, "layer"):
-                        shape.layer = layer
-                      elif hasattr(shape, "layers"):
-                        shape.layers = [layer for _ in range(len(shape.layers))]
-                      sym.add(shape)
-                  else:
-                    for ref in refs:
-                      sym.add(ref)
-
-              # add created sym to all parents
-              # TODO: it would proably be better to use the 'importSymbols' of
-              #       the PlsScript instance just before 'write_gds' is called.
-              #       Otherwise layer transformation will not work, also the
-              #       'parent' attriute is unnecessary, we have importDict
-              #       already...
-              parent = self._root.parent
-              while parent is not None:
-                _gdspy.current_library = parent.gdsLib
-                if sym.name not in parent.gdsLib:
-                  parent.gdsLib.add(sym)
-                parent = parent.parent
-              _gdspy.current_library = self._root.gdsLib
+              self._root.addParamSymbolCell(
+                    sym, self._root.paramSymbolElements(paramSym, argdict), pattern)
 
             literals[i] = ['shaperef', _gdspy.CellReference(sym)]
 
@@ -1144,6 +1081,96 @@ class CallTree:
     return unresolvedNames
 
 
+  def vectorize(self, args, argsets):
+    # evaluates the numeric parts of the tree for all argument sets of a
+    # sweep at once, parameters that change are resolved to numpy arrays.
+    # Subtrees of numeric functions are replaced by their value, of other
+    # functions only the arguments are evaluated. Returns a copy of the
+    # tree without the evaluated subtrees and the list of evaluated nodes
+    # (path, kind, literal), which fillVectorized copies into the tree for
+    # one argument set.
+    names = {}
+    for arg, column in zip(args, zip(*argsets)):
+      if all([lit == column[0] for lit in column]):
+        names[arg] = column[0]
+      elif all([lit[0] == column[0][0] and type(lit[1]) is float for lit in column]):
+        names[arg] = [column[0][0], _np.array([lit[1] for lit in column])]
+    vectorTree = _copy.deepcopy(self)
+    vectorTree.resolveNames(names)
+    plan = []
+    vectorTree._vectorizeNode((), plan)
+
+    tree = _copy.deepcopy(self)
+    for path, kind, _ in plan:
+      node = tree._node(path)
+      node._children = []
+      if kind == 'value':
+        node._func = ''
+    return tree, plan
+
+  def _vectorizeNode(self, path, plan):
+    children = [c for c in self._children if type(c) is CallTree]
+    if all([c._isNumeric() for c in children]) and self._isNumeric(own=True):
+      # empty nodes without children are parts of the parent's expression
+      if self._func in _VECTOR_FUNCS and self._children:
+        result = self._vectorEvaluate(value=True)
+        if result is not None:
+          plan.append((path, 'value', result))
+          return
+      elif self._func not in _VECTOR_FUNCS:
+        result = self._vectorEvaluate(value=False)
+        if result is not None:
+          plan.append((path, 'arguments', result))
+          return
+    for i, child in enumerate(self._children):
+      if type(child) is CallTree:
+        child._vectorizeNode(path+(i,), plan)
+
+  def _isNumeric(self, own=False):
+    # true if the literals of the node (and of all subtrees if not own)
+    # are numbers and arithmetic operators only
+    if not own and self._func not in _VECTOR_FUNCS:
+      return False
+    literals = list(getattr(self, '_literals', []))
+    if hasattr(self, '_result'):
+      literals.append(self._result)
+    return (all([_isNumericLiteral(lit) for lit in literals])
+            and (own or all([c._isNumeric() for c in self._children
+                                              if type(c) is CallTree])))
+
+  def _vectorEvaluate(self, value):
+    # returns the value of the node or its reduced arguments, None if they
+    # cannot be evaluated element-wise
+    node = _copy.deepcopy(self)
+    try:
+      with _np.errstate(all='raise'):
+        if value:
+          node.evaluate()
+        else:
+          node._reduceArguments()
+    except (ValueError, TypeError, ArithmeticError):
+      return None
+    if value:
+      result = node._literals[0] if len(node._literals) == 1 else None
+    else:
+      result = node._result
+    if result is None or not _isNumericLiteral(result):
+      return None
+    return result
+
+  def _node(self, path):
+    node = self
+    for i in path:
+      node = node._children[i]
+    return node
+
+  def fillVectorized(self, plan, index):
+    for path, kind, lit in plan:
+      node = self._node(path)
+      node._result = _pickLiteral(lit, index)
+      if kind == 'value':
+        node._literals = [node._result]
+
   def getShape(self, ref=False):
     utils.debug('getShape() called:')
     if hasattr(self, "_literals"):
@@ -1171,6 +1198,16 @@ class CallTree:
   def getShaperef(self):
     return self.getShape(ref=True)
 
+  def __deepcopy__(self, memo):
+    # copies share the script the tree belongs to, which is large and
+    # must not be copied for every instantiation of a shape
+    memo[id(self._root)] = self._root
+    result = CallTree.__new__(CallTree)
+    memo[id(self)] = result
+    for k, v in self.__dict__.items():
+      setattr(result, k, _copy.deepcopy(v, memo))
+    return result
+
   def __str__(self):
     return self._strRec()
 
@@ -1198,3 +1235,31 @@ class CallTree:
       else:
         result += child._strRec(level+1)
     return result
+
+
+def _isNumericLiteral(lit):
+  if type(lit) is not list or len(lit) != 2 or type(lit[0]) is not str:
+    return False
+  kind, value = lit
+  if kind in ['int', 'float']:
+    return isinstance(value, (int, float, _np.number, _np.ndarray))
+  elif kind == 'operator':
+    return value in _VECTOR_OPERATORS
+  elif kind in ['assignname', 'none']:
+    return True
+  elif kind == 'point':
+    return all([isinstance(v, (int, float, _np.number, _np.ndarray)) for v in value])
+  elif kind == 'argumentlist':
+    return all([_isNumericLiteral(l) for l in value])
+  elif kind == 'assignment':
+    return _isNumericLiteral(value[1])
+  return False
+
+
+def _pickLiteral(value, index):
+  # copy of a literal with the index-th element of all arrays
+  if isinstance(value, _np.ndarray):
+    return value[index].item()
+  elif type(value) in [list, tuple]:
+    return type(value)([_pickLiteral(v, index) for v in value])
+  return value
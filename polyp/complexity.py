@@ -0,0 +1,136 @@
+import json as _json
+
+from . import cache
+from . import utils
+
+# estimated sizes in bytes: gdspy keeps every polygon as a numpy array of
+# float64 coordinates, gds files store 4 byte integer coordinates with the
+# first point repeated and a few records per element
+_POLYGON_MEMORY = 136
+_VERTEX_MEMORY = 16
+_BOUNDARY_BYTES = 32
+_VERTEX_BYTES = 8
+_REFERENCE_BYTES = 24
+_ARRAY_REFERENCE_BYTES = 48
+_LABEL_BYTES = 40
+_CELL_BYTES = 36
+
+
+def _counts():
+  return {'polygons': 0, 'vertices': 0, 'memory': 0, 'gdsBytes': 0}
+
+
+def _addPolygons(counts, polygons, vertices):
+  counts['polygons'] += polygons
+  counts['vertices'] += vertices
+  counts['memory'] += polygons*_POLYGON_MEMORY + vertices*_VERTEX_MEMORY
+  counts['gdsBytes'] += polygons*_BOUNDARY_BYTES + vertices*_VERTEX_BYTES
+
+
+def cellStats(cell):
+  # counts of the elements of one cell, without the referenced cells
+  layers = {}
+  total = _counts()
+  polygonSets = cell.polygons + [path.to_polygonset() for path in cell.paths]
+  for polygonSet in polygonSets:
+    if polygonSet is None:
+      continue
+    for points, layer, datatype in zip(polygonSet.polygons, polygonSet.layers,
+                                       polygonSet.datatypes):
+      counts = layers.setdefault(f'{layer}/{datatype}', _counts())
+      _addPolygons(counts, 1, len(points))
+      _addPolygons(total, 1, len(points))
+  total['references'] = len(cell.references)
+  total['labels'] = len(cell.labels)
+  nameBytes = lambda name: 4 + len(name) + len(name)%2
+  total['gdsBytes'] += _CELL_BYTES + nameBytes(cell.name)
+  for ref in cell.references:
+    refName = ref.ref_cell if type(ref.ref_cell) is str else ref.ref_cell.name
+    total['gdsBytes'] += (_ARRAY_REFERENCE_BYTES if hasattr(ref, 'columns')
+                            else _REFERENCE_BYTES) + nameBytes(refName)
+  for label in cell.labels:
+    total['gdsBytes'] += _LABEL_BYTES + nameBytes(label.text)
+  total['memory'] += 64*(len(cell.references) + len(cell.labels))
+  return {'layers': layers, **total}
+
+
+def _sources(script):
+  # geometry sources of the script and of all scripts it imports
+  sources, seen, todo = {}, set(), [script]
+  while todo:
+    s = todo.pop()
+    if id(s) in seen:
+      continue
+    seen.add(id(s))
+    for cellName, entries in getattr(s, 'geometrySources', {}).items():
+      sources.setdefault(cellName, []).extend(entries)
+    todo.extend(getattr(s, 'importDict', {}).values())
+  return sources
+
+
+def collect(script):
+  # polygon, vertex and size counts of all cells that are written, per
+  # cell and layer, with the sections that created the geometry and the
+  # shapes these sections used
+  sources = _sources(script)
+  stats = {'cells': {}, 'shapes': {}, 'total': {**_counts(), 'cells': 0,
+                                                'references': 0}}
+  for name, cell in script.outputCells().items():
+    cellStat = cellStats(cell)
+    cellStat['sources'] = [{'source': source, 'layer': layer, 'shapes': shapes,
+                            'polygons': polygons, 'vertices': vertices}
+                              for source, layer, shapes, polygons, vertices
+                                  in sources.get(name, [])]
+    stats['cells'][name] = cellStat
+    for key in ['polygons', 'vertices', 'memory', 'gdsBytes', 'references']:
+      stats['total'][key] += cellStat[key]
+    stats['total']['cells'] += 1
+
+    # geometry of a section is attributed to all shapes the section used
+    for source in cellStat['sources']:
+      for shape in source['shapes']:
+        shapeStat = stats['shapes'].setdefault(shape, {'polygons': 0, 'vertices': 0,
+                                                       'sections': 0})
+        shapeStat['polygons'] += source['polygons']
+        shapeStat['vertices'] += source['vertices']
+        shapeStat['sections'] += 1
+  return stats
+
+
+def formatStats(stats, limit=20):
+  total = stats['total']
+  lines = [f'{total["cells"]} cells, {total["polygons"]} polygons, '
+           f'{total["vertices"]} vertices, {total["references"]} references, '
+           f'~{cache.formatSize(total["memory"])} memory, '
+           f'~{cache.formatSize(total["gdsBytes"])} gds']
+
+  cells = sorted(stats['cells'].items(), key=lambda c: -c[1]['vertices'])
+  lines.append(f'{"cells":<40} {"polygons":>10} {"vertices":>10} {"memory":>10} {"gds":>10}')
+  for name, cell in cells[:limit]:
+    lines.append(f'  {utils.shortenText(name, maxLength=36):<38} {cell["polygons"]:>10} '
+                 f'{cell["vertices"]:>10} {cache.formatSize(cell["memory"]):>10} '
+                 f'{cache.formatSize(cell["gdsBytes"]):>10}')
+    for spec, layer in sorted(cell['layers'].items(), key=lambda l: -l[1]['vertices']):
+      lines.append(f'    {"layer "+spec:<36} {layer["polygons"]:>10} '
+                   f'{layer["vertices"]:>10} {cache.formatSize(layer["memory"]):>10} '
+                   f'{cache.formatSize(layer["gdsBytes"]):>10}')
+    for source in sorted(cell['sources'], key=lambda s: -s['vertices'])[:5]:
+      shapes = f' ({", ".join(source["shapes"])})' if source['shapes'] else ''
+      lines.append(f'    from {source["source"]}{shapes}: {source["polygons"]} '
+                   f'polygons, {source["vertices"]} vertices')
+  if len(cells) > limit:
+    lines.append(f'  ... {len(cells)-limit} more')
+
+  shapes = sorted(stats['shapes'].items(), key=lambda s: -s[1]['vertices'])
+  if shapes:
+    lines.append(f'{"shapes (geometry of sections using them)":<40} '
+                 f'{"polygons":>10} {"vertices":>10} {"sections":>10}')
+    for name, shape in shapes[:limit]:
+      lines.append(f'  {name:<38} {shape["polygons"]:>10} {shape["vertices"]:>10} '
+                   f'{shape["sections"]:>10}')
+  return '\n'.join(lines)
+
+
+def writeJson(stats, path):
+  with open(path, 'w') as f:
+    _json.dump(stats, f, indent=2)
@@ -146,6 +146,13 @@ class Shape:
     return str(self)
 
 
+def unionAll(shapes):
+  # union of many shapes in one boolean operation, which is much faster
+  # than adding them one by one
+  polygons = [s._shape for s in shapes if s._shape is not None]
+  return Shape(_gdspy.fast_boolean(polygons, None, 'or') if polygons else None)
+
+
 class Rect(Shape):
   def __init__(self, p1=None, p2=None, **args):
     anchors = ['c', 'n','ne','e','se','s','sw','w','nw']
@@ -0,0 +1,202 @@
+import os as _os
+import ast as _ast
+import tracemalloc as _tracemalloc
+
+from . import cache
+from . import utils
+from . import tracing
+
+_PACKAGE = _os.path.dirname(_os.path.abspath(__file__))
+_OUTSIDE = '(outside of sections)'
+
+# subsystems of the kinds of traced spans, functions producing vertices
+# count as geometry, see _subsystem
+_SUBSYSTEMS = {'section': 'evaluate', 'function': 'evaluate', 'shape': 'evaluate',
+               'boolean': 'geometry', 'parse': 'parse', 'import': 'import',
+               'cache': 'cache', 'write': 'output'}
+
+
+def _subsystem(span):
+  if span.kind == 'function' and span.attributes.get('vertices'):
+    return 'geometry'
+  return _SUBSYSTEMS.get(span.kind, 'other')
+
+
+class MemoryProfiler(tracing.Hook):
+  # traces allocations with tracemalloc. The allocated memory is read at
+  # the start and end of every traced span and attributed to the
+  # subsystem of the innermost span (parse, evaluate, geometry, import,
+  # cache, output), see tracing.py. At the boundaries of sections,
+  # snapshots are taken to find the allocation sites of each section.
+  # With frames > 1, allocations in other packages, e.g. by deepcopy or
+  # pickle, are attributed to the polyp line calling them, which is
+  # slower.
+  def __init__(self, frames=1):
+    self.frames = frames
+    self.peak = 0
+    self.subsystems = {}
+    self.sections = {}
+    self.sites = {}
+    self._open = []
+    self._stack = []
+    self._sizes = {}
+    self._started = False
+
+  def start(self):
+    if not _tracemalloc.is_tracing():
+      _tracemalloc.start(self.frames)
+      self._started = True
+    self._sizes = self._snapshot()
+    _tracemalloc.reset_peak()
+    tracing.addHook(self)
+    return self
+
+  def stop(self):
+    tracing.removeHook(self)
+    self._interval()
+    self._boundary()
+    if self._started:
+      _tracemalloc.stop()
+      self._started = False
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *args):
+    self.stop()
+
+  def enter(self, span):
+    self._interval()
+    if span.kind == 'section':
+      self._boundary()
+      self._open.append(span.name)
+    self._stack.append([_tracemalloc.get_traced_memory()[0], 0, 0])
+
+  def exit(self, span):
+    peak = self._interval()
+    if span.kind == 'section':
+      self._boundary()
+      self._open.pop()
+    started, children, ownPeak = self._stack.pop()
+    net = _tracemalloc.get_traced_memory()[0] - started
+    if self._stack:
+      self._stack[-1][1] += net
+    subsystem = self.subsystems.setdefault(_subsystem(span),
+                                           {'peak': 0, 'net': 0, 'spans': 0})
+    subsystem['peak'] = max(subsystem['peak'], ownPeak, peak)
+    subsystem['net'] += net - children
+    subsystem['spans'] += 1
+
+  def _interval(self):
+    # peak since the last span boundary, belongs to the innermost span
+    peak = _tracemalloc.get_traced_memory()[1]
+    _tracemalloc.reset_peak()
+    self.peak = max(self.peak, peak)
+    if self._stack:
+      self._stack[-1][2] = max(self._stack[-1][2], peak)
+    else:
+      outside = self.subsystems.setdefault('other', {'peak': 0, 'net': 0, 'spans': 0})
+      outside['peak'] = max(outside['peak'], peak)
+    if self._open:
+      section = self._section(self._open[-1])
+      section['peak'] = max(section['peak'], peak)
+    return peak
+
+  def _section(self, name):
+    return self.sections.setdefault(name, {'peak': 0, 'net': 0, 'sites': {}})
+
+  def _snapshot(self):
+    # allocated bytes per site, i.e., (file, line) of the innermost polyp
+    # frame or of the allocation, without the allocations of the profiler
+    snapshot = _tracemalloc.take_snapshot().filter_traces([
+                  _tracemalloc.Filter(False, _tracemalloc.__file__, all_frames=True),
+                  _tracemalloc.Filter(False, __file__, all_frames=True),
+                  _tracemalloc.Filter(False, tracing.__file__)])
+    sizes = {}
+    for stat in snapshot.statistics('traceback' if self.frames > 1 else 'lineno'):
+      frames = list(reversed(stat.traceback))
+      frame = next((f for f in frames if _os.path.dirname(_os.path.abspath(f.filename))
+                                            == _PACKAGE), frames[0])
+      site = (frame.filename, frame.lineno)
+      sizes[site] = sizes.get(site, 0) + stat.size
+    return sizes
+
+  def _boundary(self):
+    # the change of the allocations since the last boundary belongs to the
+    # innermost section
+    sizes = self._snapshot()
+    section = self._section(self._open[-1] if self._open else _OUTSIDE)
+    for site in set(sizes) | set(self._sizes):
+      diff = sizes.get(site, 0) - self._sizes.get(site, 0)
+      if not diff:
+        continue
+      section['net'] += diff
+      section['sites'][site] = section['sites'].get(site, 0) + diff
+      # growth is the sum of all increases between two boundaries, net the
+      # memory still allocated at the end
+      stat = self.sites.setdefault(site, {'growth': 0, 'net': 0})
+      stat['growth'] += max(0, diff)
+      stat['net'] += diff
+    self._sizes = sizes
+
+  def report(self, limit=15):
+    size = cache.formatSize
+    names = _SiteNames()
+    lines = [f'peak allocated memory: {size(self.peak)}']
+    lines.append(f'{"sections":<50} {"peak":>10} {"net":>10}  largest site')
+    sections = sorted(self.sections.items(), key=lambda s: -s[1]['peak'])
+    for name, section in sections[:limit]:
+      largest = max(section['sites'].items(), key=lambda s: s[1], default=None)
+      lines.append(f'  {utils.shortenText(name, maxLength=46):<48} '
+                   f'{size(section["peak"]):>10} {_signed(section["net"]):>10}  '
+                   + (f'{names(largest[0])} {_signed(largest[1])}'
+                        if largest and largest[1] > 0 else ''))
+    if len(sections) > limit:
+      lines.append(f'  ... {len(sections)-limit} more')
+
+    lines.append(f'{"subsystems":<50} {"peak":>10} {"net":>10} {"spans":>10}')
+    for name, subsystem in sorted(self.subsystems.items(), key=lambda s: -s[1]['peak']):
+      lines.append(f'  {name:<48} {size(subsystem["peak"]):>10} '
+                   f'{_signed(subsystem["net"]):>10} {subsystem["spans"]:>10}')
+
+    lines.append(f'{"allocation sites":<50} {"growth":>10} {"net":>10}')
+    sites = sorted(self.sites.items(), key=lambda s: -s[1]['growth'])
+    for site, stat in sites[:limit]:
+      lines.append(f'  {utils.shortenText(names(site), maxLength=46):<48} '
+                   f'{size(stat["growth"]):>10} {_signed(stat["net"]):>10}')
+    if len(sites) > limit:
+      lines.append(f'  ... {len(sites)-limit} more')
+    return '\n'.join(lines)
+
+
+class _SiteNames:
+  # names 'file:line function' of sites, functions are looked up in the
+  # source files of polyp only
+  def __init__(self):
+    self._functions = {}
+
+  def _functionAt(self, path, lineno):
+    if path not in self._functions:
+      with open(path) as f:
+        tree = _ast.parse(f.read())
+      # the innermost function containing a line is the shortest one
+      self._functions[path] = sorted([(node.lineno, node.end_lineno, node.name)
+                                        for node in _ast.walk(tree)
+                                          if isinstance(node, (_ast.FunctionDef,
+                                                               _ast.ClassDef))],
+                                     key=lambda f: f[1]-f[0])
+    for first, last, name in self._functions[path]:
+      if first <= lineno <= last:
+        return name
+    return '<module>'
+
+  def __call__(self, site):
+    path, lineno = site
+    name = f'{_os.path.basename(path)}:{lineno}'
+    if _os.path.dirname(_os.path.abspath(path)) == _PACKAGE:
+      name += ' '+self._functionAt(path, lineno)
+    return name
+
+
+def _signed(n):
+  return ('-' if n < 0 else '')+cache.formatSize(abs(n))
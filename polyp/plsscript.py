@@ -6,92 +6,129 @@ import hashlib as _hashlib
 import collections as _collections
 import threading as _threading
 import matplotlib.pyplot as _plt
-import pickle as _pickle
 import copy as _copy
+import concurrent.futures as _futures
 import traceback
 import warnings
 
 from . import utils
+from . import cache
 from . import calltree
 from . import geometry
 from . import plotting
 
 class PlsScript:
-  def __init__(self, text='', forceRerender=False, parent=None):
+  def __init__(self, text='', forceRerender=False, parent=None,
+               cacheDir=None, cacheSize=None, jobs=1, registry=None,
+               evaluateOnly=None, top=None):
     self.path = ''
     self._cachedPath = ''
     self.parent = parent
+    self.top = top
+    self._evaluateOnly = evaluateOnly
+    # sweeps of imported scripts use as many jobs as the importing script
+    self.jobs = parent.jobs if parent is not None else jobs
+
+    # imported scripts share the cache of their parent
+    if parent is not None and cacheDir is None and cacheSize is None:
+      cacheStore = parent._cacheStore
+    else:
+      cacheStore = cache.CacheStore(cacheDir, cacheSize)
+    self._cacheStore = cacheStore
+
+    # all scripts of one run share the dependency graph, so that every
+    # file is read and hashed only once,
+    # and every imported script is loaded only once
+    if parent is not None:
+      self._dependencyGraph = parent._dependencyGraph
+      self._importRegistry = parent._importRegistry
+    else:
+      self._dependencyGraph = cache.DependencyGraph()
+      self._importRegistry = registry or ImportRegistry()
 
     if hasattr(text, 'read'):
       self.path = _os.path.abspath(text.name)
-      _text = ''
-      for line in text:
-        if not _re.match("\s*#", line):
-          _text += line + "\n"
-      text = _text
-
-    def getCachedPath(path):
-      if not path:
-        return ''
-      base, fname = _os.path.split(path)
-      fname = '.'.join(fname.split('.')[:-1])
-      return _os.path.join(base, '.'+fname+'.plb')
-
-    def isPathCached(path, newerThan=0):
-      if forceRerender:
-        return False
-      cachedPath = getCachedPath(path)
-      return (_os.path.exists(cachedPath)
-          and _os.path.getmtime(path) < _os.path.getmtime(cachedPath)
-          and newerThan < _os.path.getmtime(cachedPath))
-
-    def recursiveDependencyCheck(dependencies, newerThan=0):
-      newest = max([newerThan] + [_os.path.getmtime(p) for p in dependencies.keys()])
-      if not all([isPathCached(p, newerThan=newest) for p in dependencies.keys()]):
-        return False
-      return all([len(sub) == 0 or recursiveDependencyCheck(sub, newerThan=newest)
-                      for sub in dependencies.values()])
-
-    self._cachedPath = getCachedPath(self.path)
+      text = utils.readScript(text)
+
+    self._cacheReport = None
+    self._dependencyHashes = {}
+    if self.path:
+      started = _time.perf_counter()
+      self._cacheKey = self._dependencyGraph.key(self.path, text)
+      if top is not None:
+        self._cacheKey = cache.hashParts(self._cacheKey, 'top', top)
+      self._dependencyHashes = self._dependencyGraph.files(self.path)
+      self._cachedPath = cacheStore.scriptPath(self.path, self._cacheKey)
+      self._cacheReport = cacheStore.report.add(self.path, self._cachedPath)
+      self._cacheReport['validateTime'] = _time.perf_counter() - started
 
     renderFile = True
-    if isPathCached(self.path):
+    sectionCache = None
+    if not forceRerender and self._cachedPath and evaluateOnly is None:
       utils.debug('loading '+_os.path.basename(self._cachedPath)+' from cache')
+      started = _time.perf_counter()
       try:
-        self.__dict__ = _pickle.load(open(self._cachedPath, 'rb'))
-        def fixRefs(script):
-          for sec in script.sections:
-            sec._root = script
-            def fixTreeRefs(tree):
-              tree._root = script
-              for child in tree._children:
-                fixTreeRefs(child)
-            fixTreeRefs(sec._callTree)
-          for subscript in script.importDict.values():
-            fixRefs(subscript)
-        fixRefs(self)
-
-        if recursiveDependencyCheck(self._dependencies):
+        cached = cacheStore.load(self._cachedPath, self._cacheKey)
+        if cached is not None:
+          self._loadCache(*cached)
           renderFile = False
+          self._cacheReport['result'] = 'hit'
+          self._cacheReport['size'] = _os.path.getsize(self._cachedPath)
         else:
-          utils.debug('at least one dependency is outdated, rerendering...')
-
-      except:
+          utils.debug('script or at least one dependency changed, rerendering...')
+          sectionCache = cacheStore.loadSections(cacheStore.sectionsPath(self.path))
+          self._cacheReport['result'] = 'miss'
+          self._cacheReport['reasons'] = (cache.missReasons(sectionCache.files,
+                                                            self._dependencyHashes)
+                                          or ['no matching cache file'])
+
+      except KeyboardInterrupt:
+        raise
+      except Exception as e:
         utils.debug('loading failed.')
+        self._cacheReport['result'] = 'error'
+        self._cacheReport['reasons'] = ['loading failed: '+str(e)]
+      self._cacheReport['loadTime'] = _time.perf_counter() - started
+
+    elif self._cacheReport is not None:
+      self._cacheReport['result'] = 'forced'
+      self._cacheReport['reasons'] = ['forced rerender']
 
     if renderFile:
+      started = _time.perf_counter()
       if self.path:
         utils.debug('rendering '+_os.path.basename(self.path))
       self.sections = []
       self.globals = {}
-      self.shapeDict = {}
-      self.paramSymDict = {}
+      self.shapeDict = utils.LazyDict()
+      self.paramSymDict = utils.LazyDict()
       self.importDict = {}
       self.layerDict = {}
       self._dependencies = {}
-      self.gdsLib = _gdspy.GdsLibrary(unit=1e-6, precision=1e-10)
+      self._layerMaps = {}
+      self._importFiles = {}
+      self._importHashes = {}
+      self._sectionCache = {}
+      self._newSectionCache = {}
+      self._parallelKeys = set()
+      self.geometrySources = {}
+      self._reachable = None
+      self._definitions = _definitions(_splitSections(text))
+      if top is not None:
+        self._reachable = _reachableSymbols(_splitSections(text), top)
+      if sectionCache is not None:
+        self._sectionCache = sectionCache
+      elif self.path and not forceRerender:
+        self._sectionCache = cacheStore.loadSections(cacheStore.sectionsPath(self.path))
+      self.gdsLib = _newLibrary()
       _gdspy.current_library = self.gdsLib
 
+      # render imports that are not cached in parallel first, the imports
+      # are then loaded from the cache
+      if jobs > 1 and self.path:
+        self._importRegistry.renderParallel(self, jobs, forceRerender)
+        self._evaluateParallel(text, jobs, forceRerender)
+
       # split into sections:
       pos = 0
       lastHead = ""
@@ -137,8 +174,199 @@ class PlsScript:
         legendShape._shape.layers = [255 for _ in range(len(legendShape._shape.layers))]
         legendSym.add(legendShape._shape)
 
+      # sections evaluated for another process are not stored
+      if evaluateOnly is not None:
+        self.evaluatedSections = self._newSectionCache
+        del self._sectionCache, self._newSectionCache
+        return
+
+      # only keep results of sections that still exist, the section
+      # cache does not need to be part of the script state
+      if self.path:
+        self._cacheReport['renderTime'] = _time.perf_counter() - started
+        started = _time.perf_counter()
+        cacheStore.storeSections(cacheStore.sectionsPath(self.path),
+                                 self._newSectionCache, self._dependencyHashes)
+      del self._sectionCache, self._newSectionCache
+
+      # scripts with globals that are not plain data, e.g. references,
+      # are not cached
       if self._cachedPath:
-        _pickle.dump(self.__dict__, open(self._cachedPath, 'wb'))
+        try:
+          self._storeCache()
+          self._cacheReport['size'] = _os.path.getsize(self._cachedPath)
+        except ValueError as e:
+          utils.debug('storing '+_os.path.basename(self._cachedPath)+' failed: '+str(e))
+        self._cacheReport['storeTime'] = _time.perf_counter() - started
+
+
+  def _evaluateParallel(self, text, jobs, forceRerender=False):
+    # evaluates independent geometry sections in worker processes, the
+    # results are added to the section cache and are then added to the
+    # symbols in file order like cached sections
+    indices = _independentSections(_splitSections(text), self._reachable)
+    if len(indices) < 2:
+      return
+    chunks = [indices[i::jobs] for i in range(min(jobs, len(indices)))]
+    store = self._cacheStore
+    with _futures.ProcessPoolExecutor(len(chunks)) as pool:
+      for results in pool.map(_evaluateSections,
+                              [(self.path, chunk, store.directory, store.maxSize,
+                                forceRerender, sorted(self._importRegistry.fresh))
+                                    for chunk in chunks]):
+        self._sectionCache.update(results)
+        self._parallelKeys.update(results)
+
+
+  def evaluateSweep(self, obj, argsets, total, jobs, progress=None):
+    # evaluates a parameter sweep of a shape in worker processes, which
+    # load the script defining the shape without evaluating its geometry,
+    # and returns the union of the shapes of each chunk of argument sets,
+    # at most two chunks per job are generated ahead of the workers
+    path = obj['tree']._root.path
+    size = max(1, min(total//(4*jobs), utils._SWEEP_CHUNK_SIZE))
+    store = self._cacheStore
+    fresh = sorted(self._importRegistry.fresh)
+    shapes = []
+    with _futures.ProcessPoolExecutor(min(jobs, -(-total//size))) as pool:
+      futures = {}
+      for chunk in utils.chunks(argsets, size):
+        if len(futures) >= 2*jobs:
+          done, _ = _futures.wait(futures, return_when=_futures.FIRST_COMPLETED)
+          for future in done:
+            shapes.append(geometry.Shape(future.result()))
+            if progress:
+              progress.update(futures.pop(future))
+        futures[pool.submit(_evaluateSweep, (path, obj['name'], chunk, store.directory,
+                                             store.maxSize, fresh))] = len(chunk)
+      for future in _futures.as_completed(futures):
+        shapes.append(geometry.Shape(future.result()))
+        if progress:
+          progress.update(futures[future])
+    return shapes
+
+
+  def cacheReport(self):
+    # cache events of this script and all scripts it imports
+    return self._cacheStore.report
+
+
+  def _storeCache(self):
+    # store geometry as packed arrays and definitions as source text,
+    # definitions that were fully evaluated to a shape are stored as
+    # geometry to not evaluate them again
+    packer = cache.PolygonPacker()
+    shapes = {}
+    for name, shape in self.shapeDict.items():
+      shapes[name] = {'args': shape['args'],
+                      'text': shape['text'],
+                      'result': None}
+      result = getattr(shape['tree'], '_result', None)
+      if result and result[0] == 'shape':
+        if result[1]._shape is None:
+          shapes[name]['result'] = 'empty'
+        else:
+          shapes[name]['result'] = cache.packPolygonSets([result[1]._shape], packer)
+
+    # imported definitions and cells are not stored, they are imported
+    # again from the cache of the imported script when loading
+    paramSyms = {}
+    for name in self.paramSymDict:
+      if (self.paramSymDict.tag(name) is not None
+            and not self.paramSymDict.isLoaded(name)):
+        continue
+      for entry in self.paramSymDict[name]:
+        if entry['tree']._root is self:
+          paramSyms.setdefault(name, []).append(
+                                {k: entry[k] for k in ['name_pattern', 'args',
+                                                       'layer', 'text']})
+
+    header = {'hash': self.hash,
+              'layerDict': self.layerDict,
+              'globals': {name: _packLiteral(literal, packer)
+                              for name, literal in self.globals.items()},
+              'dependencies': self._dependencies,
+              'imports': [(ns, self._importFiles[ns],
+                           self._dependencyGraph.key(script.path), self._layerMaps[ns])
+                                  for ns, script in self.importDict.items()],
+              'shapes': shapes,
+              'paramSyms': paramSyms,
+              'sources': self.geometrySources,
+              'cells': cache.packCells({name: self.gdsLib.cells[name]
+                                          for name in self.gdsLib.cells
+                                            if self.gdsLib.cells.tag(name) is None},
+                                       packer)}
+    self._cacheStore.store(self._cachedPath, self._cacheKey, header, packer.arrays())
+
+
+  def _loadCache(self, header, arrays):
+    # imports are stored as written in the script, the cache file may have
+    # been written for a copy of the script in another directory
+    imports = []
+    for namespace, importFile, key, layerMap in header['imports']:
+      path = _os.path.abspath(_os.path.join(_os.path.dirname(self.path), importFile))
+      if self._dependencyGraph.key(path) != key:
+        raise ValueError('cache file was written for another version of '+importFile)
+      imports.append((namespace, importFile, path, layerMap))
+
+    packed = cache.PackedPolygons(arrays)
+    self.sections = []
+    self.hash = header['hash']
+    self.layerDict = header['layerDict']
+    self.globals = {name: _unpackLiteral(literal, packed)
+                      for name, literal in header['globals'].items()}
+    self._dependencies = header['dependencies']
+    self.geometrySources = header['sources']
+
+    self.gdsLib = _newLibrary()
+    self.importDict = {}
+    self.paramSymDict = utils.LazyDict()
+    self._layerMaps = {}
+    self._importFiles = {}
+    for namespace, importFile, path, layerMap in imports:
+      script = self._importRegistry.load(path, self)
+      self.importDict[namespace] = script
+      self._layerMaps[namespace] = layerMap
+      self._importFiles[namespace] = importFile
+      self.importSymbols(script.gdsLib, layerMap, namespace)
+      self.importParamSyms(script, namespace)
+
+    # definitions are only parsed and cells only unpacked when they are
+    # used for the first time
+    self.shapeDict = utils.LazyDict()
+    for name, shape in header['shapes'].items():
+      self.shapeDict.setLazy(name, lambda name=name, shape=shape:
+                                            self._loadShape(name, shape, packed))
+
+    for name, entries in header['paramSyms'].items():
+      imported = []
+      if name in self.paramSymDict:
+        imported = self.paramSymDict[name]
+      self.paramSymDict.setLazy(name, lambda entries=entries, imported=imported:
+                    imported + [dict(entry, tree=_parseTree(self, entry['text']))
+                                  for entry in entries])
+
+    cache.unpackCells(header['cells'], packed, self.gdsLib)
+    self._cachedCells = (header['cells'], packed)
+    _gdspy.current_library = self.gdsLib
+
+
+  def _loadShape(self, name, shape, packed):
+    if shape['result'] is None:
+      tree = _parseTree(self, shape['text'])
+    else:
+      if shape['result'] == 'empty':
+        s = geometry.Shape()
+      else:
+        s = geometry.Shape(packed.polygonSet(*shape['result']))
+      tree = calltree.CallTree(self)
+      tree._children = [calltree.CallTree(self)]
+      tree._children[0]._literals = [['shape', s]]
+      tree._result = ['shape', s]
+    return {'name': name,
+            'args': shape['args'],
+            'text': shape['text'],
+            'tree': tree}
 
 
   def lookupLayerNum(self, layerName, default=None):
@@ -158,22 +386,112 @@ class PlsScript:
 
 
   def _sortLibrary(self):
-    self.gdsLib.cells = _collections.OrderedDict([(k, v)
-                for k, v in sorted(self.gdsLib.cells.items())])
+    if isinstance(self.gdsLib.cells, utils.LazyDict):
+      self.gdsLib.cells.sortKeys()
+    else:
+      self.gdsLib.cells = _collections.OrderedDict([(k, v)
+                  for k, v in sorted(self.gdsLib.cells.items())])
+
+
+  def outputNames(self):
+    # names of the cells of this script, of the symbols of the directly
+    # imported scripts and of the imported cells they use, other cells of
+    # nested imports are not extracted from the imported library
+    cells = self.gdsLib.cells
+    if self.top is not None:
+      if self.top not in cells:
+        raise ValueError('Top cell "'+self.top+'" does not exist.')
+      result = [self.top]
+    elif not isinstance(cells, utils.LazyDict):
+      return sorted(cells)
+    else:
+      # the generated legend does not count as a symbol of this script
+      result = [name for name in cells if cells.tag(name) is None]
+      if not [name for name in result if name != 'legend']:
+        return sorted(cells)
+      # symbols of directly imported scripts are written as well, the
+      # symbols of their imports only if they are referenced
+      for namespace, script in self.importDict.items():
+        result += [name for name in cells
+                      if cells.tag(name) == namespace and name in script.gdsLib.cells
+                        and script.gdsLib.cells.tag(name) is None]
+    todo = list(result)
+    while todo:
+      for ref in self._cellReferences(todo.pop()):
+        if ref in cells and ref not in result:
+          result.append(ref)
+          todo.append(ref)
+    return sorted(result)
+
+
+  def outputCells(self):
+    return {name: self.gdsLib.cells[name] for name in self.outputNames()}
+
+
+  def _cellReferences(self, name):
+    # names of the cells referenced by the named cell, without loading it
+    cells = self.gdsLib.cells
+    if not isinstance(cells, utils.LazyDict) or cells.isLoaded(name):
+      return [ref.ref_cell.name if isinstance(ref.ref_cell, _gdspy.Cell)
+                                else ref.ref_cell
+                  for ref in cells[name].references]
+    tag = cells.tag(name)
+    if tag is None:
+      return [ref['cell'] for ref in self._cachedCells[0][name]['references']]
+    return self.importDict[tag]._cellReferences(name)
+
+
+  def _streamCell(self, name):
+    # the cell to write for the named cell, cells that are not loaded are
+    # only created temporarily, with references to cells by name
+    cells = self.gdsLib.cells
+    if not isinstance(cells, utils.LazyDict) or cells.isLoaded(name):
+      return cells[name]
+    tag = cells.tag(name)
+    if tag is None:
+      meta, packed = self._cachedCells
+      return cache.unpackCell(name, meta[name], packed, lambda refName: refName)
+    cell = self.importDict[tag]._streamCell(name)
+    elements, changed = _remapElements(cell, self._layerMaps.get(tag, {}))
+    if changed:
+      cell, orig = _gdspy.Cell(name, exclude_from_current=True), cell
+      cell.add(elements)
+      cell.add(orig.references)
+    return cell
+
+
+  def streamResults(self, path):
+    # writes the gds file cell by cell, cells that are not loaded yet are
+    # not kept in memory after they were written. Rendered cells are
+    # already in memory, they cannot be released while rendering because
+    # the cache file of the script, --stats and the viewer use them after
+    # the script is finished.
+    writer = _gdspy.GdsWriter(path, name=self.gdsLib.name, unit=self.gdsLib.unit,
+                              precision=self.gdsLib.precision)
+    try:
+      for name in self.outputNames():
+        writer.write_cell(self._streamCell(name))
+    finally:
+      writer.close()
 
 
-  def writeResults(self, path, pdfWidth=12, pdfTitle=None, pdfGrid=False):
+  def writeResults(self, path, pdfWidth=12, pdfTitle=None, pdfGrid=False,
+                   stream=False):
     _gdspy.current_library = self.gdsLib
     self._sortLibrary()
-    if path.endswith(".gds"):
+    if path.endswith(".gds") and stream:
+      self.streamResults(path)
+
+    elif path.endswith(".gds"):
       _gdspy.current_library = self.gdsLib
-      self.gdsLib.write_gds(path)
+      self.gdsLib.write_gds(path, cells=list(self.outputCells().values()))
 
     elif path.endswith(".pdf"):
+      cells = self.outputCells()
       baseName = path[:-4]
-      for symName, symbol in self.gdsLib.cells.items():
+      for symName, symbol in cells.items():
         try:
-          if len(self.gdsLib.cells.keys()) > 1:
+          if len(cells) > 1:
             ext = "/"+symName
           else:
             ext = ""
@@ -187,7 +505,7 @@ class PlsScript:
           if not pdfTitle is None:
             _plt.title(pdfTitle)
           _plt.grid(pdfGrid)
-          plotting.plot(self.gdsLib.cells, symName)
+          plotting.plot(cells, symName)
           _plt.xlabel("X [$\mu$m]")
           _plt.ylabel("Y [$\mu$m]")
           _plt.legend()
@@ -202,21 +520,164 @@ class PlsScript:
       raise ValueError("Unknown file extension: '*.{}'".format(path.split('.')[-1]))
 
 
-  def importSymbols(self, lib, layerMap={}):
-    libDuplicate = _copy.deepcopy(lib)
-    for layerFrom, layerTo in layerMap.items():
-      for cell, origCell in zip(libDuplicate.cells.values(), lib.cells.values()):
-        if hasattr(cell, 'elements'):
-          for elem, origElem in zip(cell.elements, origCell.elements):
-            for i in range(len(elem.layers)):
-              if origElem.layers[i] == layerFrom:
-                elem.layers[i] = layerTo
+  def importSymbols(self, lib, layerMap={}, namespace=None):
+    # imported cells are used directly, only cells containing remapped
+    # layers or referencing such cells are replaced by copies, which
+    # share the polygon data with the imported cells. Both happens when
+    # a cell is used for the first time, existing cells are kept.
+    remapped = {}
+    def remapCell(name):
+      orig = lib.cells[name]
+      if not layerMap:
+        return orig
+      if name not in remapped:
+        elements, changed = _remapElements(orig, layerMap)
+
+        references = []
+        for ref in orig.references:
+          refCell = ref.ref_cell
+          if (isinstance(refCell, _gdspy.Cell) and refCell.name in lib.cells
+                and lib.cells[refCell.name] is refCell):
+            refCell = remapCell(refCell.name)
+            if refCell is not ref.ref_cell:
+              ref = _copy.copy(ref)
+              ref.ref_cell = refCell
+              changed = True
+          references.append(ref)
+
+        if changed:
+          cell = _gdspy.Cell(name, exclude_from_current=True)
+          cell.add(elements)
+          cell.add(references)
+          remapped[name] = cell
+        else:
+          remapped[name] = orig
+      return remapped[name]
+
+    for name in lib.cells:
+      if name not in self.gdsLib.cells:
+        self.gdsLib.cells.setLazy(name, lambda name=name: remapCell(name),
+                                  tag=namespace or '')
+
+
+  def importParamSyms(self, script, namespace=None):
+    for name in script.paramSymDict:
+      if name in self.paramSymDict:
+        raise ValueError("Duplicate parametric symbol name "+str(name))
+      self.paramSymDict.setLazy(name, lambda name=name: script.paramSymDict[name],
+                                tag=namespace or '')
+
+
+  def addGeometrySource(self, cellName, layer, source, text, polygons):
+    # remembers how much geometry a section added to a cell and which
+    # shapes it used, see complexity.py
+    names = _identifiers(text)
+    shapes = sorted([name for name in names
+                      if name in self.shapeDict
+                        or any([name in script.shapeDict
+                                  for script in self.importDict.values()])])
+    self.geometrySources.setdefault(cellName, []).append(
+              (source, layer, shapes, len(polygons), sum(map(len, polygons))))
+
+
+  def symbolCell(self, name):
+    # returns the cell of the named symbol, creates the cell if it does not
+    # exist yet, imported cells that are modified are copied and become
+    # part of this script
+    if name in self.gdsLib.cells:
+      sym = self.gdsLib.cells[name]
+      if self.gdsLib.cells.tag(name) is not None:
+        orig, sym = sym, _gdspy.Cell(name, exclude_from_current=True)
+        sym.add(orig.polygons + orig.paths + orig.labels + orig.references)
+      self.gdsLib.cells[name] = sym
+    else:
+      _gdspy.current_library = self.gdsLib
+      sym = _gdspy.Cell(name)
+      self.gdsLib.add(sym)
+    return sym
+
+
+  def paramSymbol(self, name):
+    # sections of the parametric symbol name, names are compared ignoring
+    # case, placeholders, dashes and underscores
+    _cmp = lambda s: _re.sub(r'[\-_\{\}]+', '', s.lower())
+    for candidateName in self.paramSymDict:
+      if _cmp(candidateName) == _cmp(name):
+        utils.debug(f'matched {name} with {candidateName}')
+        return self.paramSymDict[candidateName]
+    raise ValueError('tried to create reference to undefined '
+                     'parametric symbol "'+str(name)+'" '
+                     '(symbols may only be used after '
+                     'their definition)')
+
+
+  def paramSymbolElements(self, paramSym, argdict):
+    # evaluates the sections of a parametric symbol for the arguments in
+    # argdict, returns the shapes as (layer, shape, section) and the
+    # references
+    shapes, refs = [], []
+    for section in paramSym:
+      tree = _copy.deepcopy(section['tree'])
+      # replace root reference with true reference:
+      tree._root = section['tree']._root
+
+      layer = section['layer']
+      unresolvedNames = tree.resolveNames(argdict)
+      tree.evaluate(resolveGlobals=True)
+      if tree._result[0] != 'none':
+        shapeResult = False
+        try:
+          s = tree.getShape()
+          shapeResult = True
+        except ValueError:
+          refs += tree.getShaperef()
+        if shapeResult:
+          if s is None:
+            if unresolvedNames:
+              raise ValueError('unresolved name(s) in layer shapes: '
+                                    +', '.join(['"'+n+'"'
+                                        for n in unresolvedNames]))
+            else:
+              raise ValueError('unexpected None-shape found '
+                               'after instanciation '
+                               'of parametric symbol:\n'+str(tree))
+
+          shape = s._shape
+          if not shape is None:
+            if hasattr(shape, "layer"):
+              shape.layer = layer
+            elif hasattr(shape, "layers"):
+              shape.layers = [layer for _ in range(len(shape.layers))]
+            shapes.append((layer, shape, section))
+    return shapes, refs
+
+
+  def addParamSymbolCell(self, sym, elements, pattern):
+    # adds the elements of paramSymbolElements to the cell sym of an
+    # instance of the parametric symbol pattern, and the cell to the
+    # libraries of this script and of all scripts importing it
+    shapes, refs = elements
+    for layer, shape, section in shapes:
+      sym.add(shape)
+      self.addGeometrySource(sym.name, layer,
+                             _os.path.basename(section['tree']._root.path)
+                               +':SYMBOL '+pattern+' LAYER '+str(layer),
+                             section['text'], shape.polygons)
+    for ref in refs:
+      sym.add(ref)
+
+    # TODO: it would proably be better to use the 'importSymbols' of
+    #       the PlsScript instance just before 'write_gds' is called.
+    #       Otherwise layer transformation will not work, also the
+    #       'parent' attriute is unnecessary, we have importDict
+    #       already...
+    script = self
+    while script is not None:
+      _gdspy.current_library = script.gdsLib
+      if sym.name not in script.gdsLib:
+        script.gdsLib.add(sym)
+      script = script.parent
     _gdspy.current_library = self.gdsLib
-    for symName in libDuplicate.cells:
-      try:
-        libDuplicate.extract(symName)
-      except:
-        pass
 
 
   def openViewer(self, currentLibMtl=None):
@@ -256,6 +717,287 @@ class PlsScript:
     return "\n".join(str(s) for s in self.sections)
 
 
+class ImportRegistry:
+  # scripts imported during one run, keyed by path and content key, so
+  # that a script imported along several paths is only loaded once.
+  # Scripts in fresh were rendered in this run already and are loaded
+  # from the cache even if rerendering is forced.
+  def __init__(self, fresh=()):
+    self._scripts = {}
+    self._used = set()
+    self._current = set()
+    self.fresh = set(fresh)
+
+  def begin(self, fresh=()):
+    # starts a new run, e.g. a request of the server, with a registry that
+    # keeps the scripts of earlier runs
+    self.fresh = set(fresh)
+    self._current = set()
+
+  def currentPaths(self):
+    # paths of all scripts that were imported in the current run
+    return {path for (path, _), script in self._scripts.items()
+                     if id(script) in self._current}
+
+  def load(self, path, parent, forceRerender=False):
+    path = _os.path.abspath(path)
+    key = (path, parent._dependencyGraph.key(path))
+    script = self._scripts.get(key)
+    # scripts of earlier runs are rendered again if rerendering is forced
+    if (script is not None and id(script) not in self._current
+          and forceRerender and path not in self.fresh):
+      script = None
+    if script is None:
+      script = self._scripts[key] = PlsScript(open(path, 'r'),
+                                              forceRerender=(forceRerender
+                                                             and path not in self.fresh),
+                                              parent=parent)
+      self._current.add(id(script))
+    elif id(script) not in self._current:
+      self._reuse(script, parent)
+    self._used.add(key)
+    return script
+
+  def _reuse(self, script, parent):
+    # a script of an earlier run becomes part of this run, together with
+    # the scripts it imports
+    self._current.add(id(script))
+    script.parent = parent
+    script._cacheStore = parent._cacheStore
+    script._cacheReport = parent._cacheStore.report.add(script.path, script._cachedPath)
+    script._cacheReport['result'] = 'reused'
+    script._cacheReport['reasons'] = ['loaded by an earlier run']
+    for imported in script.importDict.values():
+      if id(imported) not in self._current:
+        self._reuse(imported, script)
+
+  def prune(self):
+    # forgets all scripts that were not imported since the last prune,
+    # neither directly nor by one of the imported scripts
+    used = [self._scripts[key] for key in self._used if key in self._scripts]
+    keep = set()
+    while used:
+      script = used.pop()
+      if id(script) not in keep:
+        keep.add(id(script))
+        used.extend(script.importDict.values())
+    self._scripts = {key: script for key, script in self._scripts.items()
+                                      if id(script) in keep}
+    self._used = set()
+
+  def renderParallel(self, root, jobs, forceRerender=False):
+    # renders all imports of root that are not cached in worker processes,
+    # in waves of imports whose own imports are rendered already. The
+    # workers store their results in the cache, so only file names have
+    # to be passed around.
+    graph = root._dependencyGraph
+    store = root._cacheStore
+    imports = graph.order(root.path)[:-1]
+    pending = [path for path in imports
+                  if path not in self.fresh
+                    and (forceRerender
+                         or not store.isCached(store.scriptPath(path, graph.key(path)),
+                                               graph.key(path)))]
+    if not pending:
+      return
+
+    with _futures.ProcessPoolExecutor(min(jobs, len(pending))) as pool:
+      while pending:
+        wave = [path for path in pending
+                  if all([importPath not in pending
+                              for _, importPath in graph.add(path)])]
+        for reportEntries in pool.map(_renderImport,
+                                      [(path, store.directory, store.maxSize,
+                                        forceRerender, sorted(self.fresh))
+                                          for path in wave]):
+          store.report.scripts.extend(reportEntries)
+        self.fresh.update(wave)
+        pending = [path for path in pending if path not in wave]
+
+
+def _splitSections(text):
+  # (head, text) of all sections, split the same way as in PlsScript
+  matches = list(_re.finditer("(SHAPE|SYMBOL|LAYER|IMPORT|GLOBALS).*\n", text))
+  return [(text[m.start():m.end()],
+           text[m.end():matches[i+1].start() if i+1 < len(matches) else len(text)])
+                for i, m in enumerate(matches)]
+
+
+def _identifiers(text):
+  return set(_re.findall("[a-zA-Z_][a-zA-Z0-9_]*", text))
+
+
+def _definitions(sections):
+  # (kind, text hash, identifiers used) of the shapes, globals and
+  # parametric symbols defined by the sections, by the defined name. They
+  # are found without evaluating anything, so that the cache keys of all
+  # sections can cover definitions that come later in the script.
+  result = {}
+  paramSym = None
+  for head, text in sections:
+    words = head.split()
+    if words[0] == 'SYMBOL':
+      paramSym = None
+      if _re.search(r"\(\s*[^)\s]", head):
+        paramSym = _re.sub(r"\{[^}]*\}", "", ' '.join(words[1:]).split('(')[0]).strip()
+    definition = (cache.hashParts(head, text), _identifiers(text))
+    if words[0] == 'SHAPE':
+      name = ' '.join(words[1:]).split('(')[0].strip()
+      result.setdefault(name, []).append(('shape', *definition))
+    elif words[0] == 'GLOBALS':
+      for name in _re.findall(r"^\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*=", text, _re.M):
+        result.setdefault(name, []).append(('global', *definition))
+    elif words[0] in ['SYMBOL', 'LAYER'] and paramSym:
+      result.setdefault(paramSym, []).append(('paramsym', *definition))
+  return result
+
+
+def _symbolKey(name):
+  # symbol names are matched like in ref(...) of parametric symbols
+  name = _re.sub(r"\{[^}]*\}", "", name.split('(')[0])
+  return _re.sub(r'[\-_\{\}\s]+', '', name.lower())
+
+
+def _sectionSymbols(sections):
+  # (symbol key, parametric) of the SYMBOL context of each section, found
+  # without evaluating anything
+  result = []
+  symbol, parametric = None, False
+  for head, text in sections:
+    words = head.split()
+    if words[0] == 'SYMBOL':
+      symbol = _symbolKey(' '.join(words[1:]))
+      parametric = bool(_re.search(r"\(\s*[^)\s]", head))
+    result.append((symbol, parametric))
+  return result
+
+
+def _independentSections(sections, reachable=None):
+  # indices of non-parametric SYMBOL/LAYER sections that do not create
+  # references, their results only depend on definitions
+  result = []
+  for i, ((head, text), (symbol, parametric)) in enumerate(
+                                      zip(sections, _sectionSymbols(sections))):
+    keyword = head.split()[0]
+    if (keyword in ['SYMBOL', 'LAYER'] and not parametric and text.strip()
+          and (reachable is None or symbol in reachable)):
+      names = _identifiers(text)
+      if not names & {'ref', '__DATE__', '__TIME__'}:
+        result.append(i)
+  return result
+
+
+def _reachableSymbols(sections, top):
+  # keys of all symbols that are referenced from top directly or
+  # indirectly, including parametric symbols
+  refs = {}
+  for (head, text), (symbol, _) in zip(sections, _sectionSymbols(sections)):
+    if head.split()[0] in ['SYMBOL', 'LAYER'] and symbol is not None:
+      refs.setdefault(symbol, set()).update(
+              [_symbolKey(name) for name in
+                  _re.findall(r"\bref\s*\(\s*([a-zA-Z_][a-zA-Z0-9_]*)", text)])
+  reachable = set()
+  todo = [_symbolKey(top)]
+  while todo:
+    symbol = todo.pop()
+    if symbol not in reachable:
+      reachable.add(symbol)
+      todo.extend(refs.get(symbol, []))
+  return reachable
+
+
+def _evaluateSections(args):
+  path, indices, cacheDir, cacheSize, forceRerender, fresh = args
+  script = PlsScript(open(path, 'r'), forceRerender, cacheDir=cacheDir,
+                     cacheSize=cacheSize, registry=ImportRegistry(fresh),
+                     evaluateOnly=set(indices))
+  return script.evaluatedSections
+
+
+def _evaluateSweep(args):
+  path, name, argsets, cacheDir, cacheSize, fresh = args
+  script = PlsScript(open(path, 'r'), cacheDir=cacheDir, cacheSize=cacheSize,
+                     registry=ImportRegistry(fresh), evaluateOnly=set())
+  return geometry.unionAll(utils.sweepShapes(script.shapeDict[name], argsets))._shape
+
+
+def _renderImport(args):
+  path, cacheDir, cacheSize, forceRerender, fresh = args
+  script = PlsScript(open(path, 'r'), forceRerender, cacheDir=cacheDir,
+                     cacheSize=cacheSize, registry=ImportRegistry(fresh))
+  return script.cacheReport().scripts
+
+
+def _packLiteral(literal, packer):
+  # shapes in literals, e.g. of globals, are stored as packed polygons
+  kind, value = literal
+  if kind == 'shape':
+    return [kind, 'empty' if value._shape is None
+                    else cache.packPolygonSets([value._shape], packer)]
+  if kind == 'obj':
+    return [kind, {k: _packLiteral(v, packer) for k, v in value.items()}]
+  if kind == 'argumentlist':
+    return [kind, [_packLiteral(v, packer) for v in value]]
+  if kind == 'point':
+    return [kind, list(value)]
+  return literal
+
+
+def _unpackLiteral(literal, packed):
+  kind, value = literal
+  if kind == 'shape':
+    return [kind, geometry.Shape() if value == 'empty'
+                    else geometry.Shape(packed.polygonSet(*value))]
+  if kind == 'obj':
+    return [kind, {k: _unpackLiteral(v, packed) for k, v in value.items()}]
+  if kind == 'argumentlist':
+    return [kind, [_unpackLiteral(v, packed) for v in value]]
+  return literal
+
+
+def _remapElements(cell, layerMap):
+  # elements of cell with layers replaced according to layerMap, elements
+  # that change are copied, but share the polygon data with the original
+  changed = False
+  elements = []
+  for elem in cell.polygons + cell.paths + cell.labels:
+    if hasattr(elem, 'layers'):
+      if any([l in layerMap for l in elem.layers]):
+        elem = _copy.copy(elem)
+        elem.layers = [layerMap.get(l, l) for l in elem.layers]
+        changed = True
+    elif elem.layer in layerMap:
+      elem = _copy.copy(elem)
+      elem.layer = layerMap[elem.layer]
+      changed = True
+    elements.append(elem)
+  return elements, changed
+
+
+def _newLibrary():
+  lib = _gdspy.GdsLibrary(unit=1e-6, precision=1e-10)
+  lib.cells = utils.LazyDict()
+  return lib
+
+
+def _parseTree(root, text):
+  # parse text into calltree and evaluate once, ignoring all errors
+  # caused by unresolved names, to simplify trees as far as possible
+  tree = calltree.CallTree(root, text)
+  tree.createLiterals()
+  try:
+    tree.evaluate()
+  except KeyboardInterrupt:
+    raise
+  except ValueError as e:
+    if (('operands' in str(e) and 'name' in str(e))
+        or str(e).lower().startswith('unresolved')):
+      pass
+    else:
+      raise
+  return tree
+
+
 class _ScriptSection:
   def __init__(self, root, head, text, prevSection, forceRerender=False):
     self._root = root
@@ -288,11 +1030,13 @@ class _ScriptSection:
       suffix = importPath.split(".")[-1]
 
       if suffix == 'pls':
-        script = PlsScript(open(importPath, 'r'),
-                           forceRerender=forceRerender,
-                           parent=root)
-        root._dependencies[importPath] = script._dependencies
+        script = root._importRegistry.load(importPath, root, forceRerender)
+        root._dependencies[self._importFile] = script._dependencies
         root.importDict[self._namespace] = script
+        root._importFiles[self._namespace] = self._importFile
+        root._importHashes[self._namespace] = (script._cacheKey
+                                               if script._cachedPath
+                                               else script.hash)
 
         # convert layers
         layerMap = {}
@@ -302,11 +1046,9 @@ class _ScriptSection:
             if lookedupNum != num:
               layerMap[num] = lookedupNum
 
-        self._root.importSymbols(script.gdsLib, layerMap)
-        for name, sym in script.paramSymDict.items():
-          if name in self._root.paramSymDict.keys():
-            raise ValueError("Duplicate parametric symbol name "+str(name))
-          self._root.paramSymDict[name] = sym
+        root._layerMaps[self._namespace] = layerMap
+        root.importSymbols(script.gdsLib, layerMap, self._namespace)
+        root.importParamSyms(script, self._namespace)
       else:
         raise ValueError('Unsupported import file format "'+suffix+'"')
 
@@ -424,6 +1166,30 @@ class _ScriptSection:
         self._layer = prev._layer
       prev = prev._prev
 
+    #=====================================================================
+    # reuse result of an unchanged section from the section cache
+    self._cacheKey = self._computeCacheKey()
+    self._callTree = None
+    isGeometry = head[0] in ['SYMBOL', 'LAYER'] and not self._isParametricSymbol
+
+    # skip symbols that are not used by the requested top cell, but keep
+    # their cached results for later builds
+    if (isGeometry and root._reachable is not None
+          and _symbolKey(self._symbol or '') not in root._reachable):
+      if self._cacheKey in root._sectionCache:
+        root._newSectionCache[self._cacheKey] = root._sectionCache[self._cacheKey]
+      return
+
+    if isGeometry and self._cacheKey in root._sectionCache:
+      if root._evaluateOnly is None:
+        self._addCachedResult(root._sectionCache[self._cacheKey])
+      return
+
+    # when evaluating sections for another process, skip all others
+    if (isGeometry and root._evaluateOnly is not None
+          and len(root.sections) not in root._evaluateOnly):
+      return
+
     #=====================================================================
     # insert parentheses and commas if GLOBALS section
     if head[0] == 'GLOBALS':
@@ -432,21 +1198,7 @@ class _ScriptSection:
                                       if s.strip()])+')'
 
     # parse section text into calltree
-    self._callTree = calltree.CallTree(root, self._text)
-    self._callTree.createLiterals()
-
-    # evaluate once and ignore all errors to simplify trees as far
-    # as possible
-    try:
-      self._callTree.evaluate()
-    except KeyboardInterrupt:
-      raise
-    except ValueError as e:
-      if (('operands' in str(e) and 'name' in str(e))
-          or str(e).lower().startswith('unresolved')):
-        pass
-      else:
-        raise
+    self._callTree = _parseTree(root, self._text)
 
     # if not in shape or parametric symbol definition, evaluate
     # a second time, also resolve for globals and raise if error
@@ -455,7 +1207,9 @@ class _ScriptSection:
 
     # shape
     if head[0] == "SHAPE":
-      root.shapeDict[self._shapeName] = {"args": self._args,
+      root.shapeDict[self._shapeName] = {"name": self._shapeName,
+                                         "args": self._args,
+                                         "text": self._text,
                                          "tree": self._callTree}
 
     elif head[0] == 'GLOBALS':
@@ -471,9 +1225,13 @@ class _ScriptSection:
     elif self._isParametricSymbol:
       if self._cleanName not in root.paramSymDict.keys():
         root.paramSymDict[self._cleanName] = []
+      elif root.paramSymDict.tag(self._cleanName) is not None:
+        # do not modify definitions of the imported script
+        root.paramSymDict[self._cleanName] = list(root.paramSymDict[self._cleanName])
       root.paramSymDict[self._cleanName].append(
                                 {"name_pattern": self._symNamePattern,
                                  "args": self._args,
+                                 "text": self._text,
                                  "tree": self._callTree,
                                  "layer": self._layer})
 
@@ -485,11 +1243,7 @@ class _ScriptSection:
                             for res in self._callTree._result])):
       if not self._symbol:
         raise ValueError('Shaperefs found without symbol context')
-      if self._symbol in root.gdsLib.cells:
-        sym = root.gdsLib.cells[self._symbol]
-      else:
-        sym = _gdspy.Cell(self._symbol)
-        root.gdsLib.add(sym)
+      sym = root.symbolCell(self._symbol)
       for ref in self._callTree._result:
         sym.add(ref[1])
 
@@ -498,11 +1252,7 @@ class _ScriptSection:
             and self._callTree._result[0] == 'shape'):
       if not self._symbol or type(self._layer) is not int:
         raise ValueError('Shapes found without symbol or layer context')
-      if self._symbol in root.gdsLib.cells:
-        sym = root.gdsLib.cells[self._symbol]
-      else:
-        sym = _gdspy.Cell(self._symbol)
-        root.gdsLib.add(sym)
+      sym = root.symbolCell(self._symbol)
 
       s = self._callTree.getShape()
       if s is None:
@@ -515,6 +1265,72 @@ class _ScriptSection:
         elif hasattr(shape, "layers"):
           shape.layers = [self._layer for _ in range(len(shape.layers))]
         sym.add(shape)
+        root.addGeometrySource(self._symbol, self._layer, self._sourceName(),
+                               self._text, shape.polygons)
+
+      if root._cacheReport is not None:
+        root._cacheReport['sectionMisses'] += 1
+      if self._cacheKey is not None:
+        if shape is None:
+          root._newSectionCache[self._cacheKey] = ([], [])
+        else:
+          root._newSectionCache[self._cacheKey] = (list(shape.polygons),
+                                                   list(shape.datatypes))
+
+
+  def _computeCacheKey(self):
+    # the key of a section covers its own text and context, the texts of
+    # all definitions of the script it might reference, also indirectly
+    # and wherever they are in the script, and the keys of the imports.
+    # Sections using the current date or time are never cached.
+    root = self._root
+    names = _identifiers(self._text)
+    parts = [self._head, self._text, self._symbol, self._layer,
+             self._isParametricSymbol]
+    todo = sorted(names, reverse=True)
+    while todo:
+      name = todo.pop()
+      for kind, textHash, used in root._definitions.get(name, []):
+        parts.append(kind+' '+name+' '+textHash)
+        todo.extend(sorted(used - names, reverse=True))
+        names |= used
+    if '__DATE__' in names or '__TIME__' in names:
+      return None
+
+    for name in sorted(names):
+      if name in root._importHashes:
+        parts.append('import '+name+' '+root._importHashes[name])
+    if '__HASH__' in names:
+      parts.append('hash '+root.hash)
+    if '__FILENAME__' in names:
+      parts.append('filename '+_os.path.basename(root.path))
+    return cache.hashParts(*parts)
+
+
+  def _sourceName(self):
+    name = self._head
+    if name.startswith('LAYER') and self._symbol:
+      name = 'SYMBOL '+self._symbol+' '+name
+    return _os.path.basename(self._root.path)+':'+name
+
+
+  def _addCachedResult(self, result):
+    root = self._root
+    if not self._symbol or type(self._layer) is not int:
+      raise ValueError('Shapes found without symbol or layer context')
+    sym = root.symbolCell(self._symbol)
+
+    if self._cacheKey in root._parallelKeys:
+      root._cacheReport['sectionMisses'] += 1
+    else:
+      root._cacheReport['sectionHits'] += 1
+    polygons, datatypes = result
+    if polygons:
+      sym.add(_gdspy.PolygonSet(polygons, layer=self._layer))
+      sym.polygons[-1].datatypes = list(datatypes)
+      root.addGeometrySource(self._symbol, self._layer, self._sourceName(),
+                             self._text, polygons)
+    root._newSectionCache[self._cacheKey] = result
 
 
   def __str__(self):
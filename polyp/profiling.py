@@ -0,0 +1,75 @@
+from . import utils
+from . import tracing
+
+
+class Profiler(tracing.Hook):
+  # measures wall time, calls and produced vertices of all traced spans,
+  # i.e., script sections, functions, shapes, booleans, parsing, imports,
+  # cache files and output files, see tracing.py
+  def __init__(self):
+    self.stats = {}
+    self.stacks = {}
+    self._childTimes = []
+
+  def start(self):
+    tracing.addHook(self)
+    return self
+
+  def stop(self):
+    tracing.removeHook(self)
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *args):
+    self.stop()
+
+  def enter(self, span):
+    self._childTimes.append(0.)
+
+  def exit(self, span):
+    childTime = self._childTimes.pop()
+    elapsed = span.duration
+    if self._childTimes:
+      self._childTimes[-1] += elapsed
+    name = span.name.replace(';', ',')
+    stat = self.stats.setdefault((span.kind, name), [0, 0., 0., 0])
+    stat[0] += 1
+    # recursive calls are contained in the total of the outermost call
+    parent = span.parent
+    while parent is not None and (parent.kind, parent.name) != (span.kind, span.name):
+      parent = parent.parent
+    if parent is None:
+      stat[1] += elapsed
+    stat[2] += elapsed - childTime
+    stat[3] += span.attributes.get('vertices', 0)
+    path = ';'.join([n.replace(';', ',') for n in span.path()])
+    self.stacks[path] = self.stacks.get(path, 0.) + elapsed - childTime
+
+  def report(self, limit=25):
+    lines = []
+    for kinds, title in [(['section'], 'sections'),
+                         (['function', 'shape', 'boolean'], 'functions and shapes'),
+                         (['parse', 'import'], 'parsing and imports'),
+                         (['cache', 'write'], 'cache and output files')]:
+      rows = sorted([(stat, name) for (kind, name), stat in self.stats.items()
+                                                          if kind in kinds],
+                    key=lambda r: -r[0][1])
+      if not rows and kinds[0] != 'section':
+        continue
+      lines.append(f'{title:<50} {"calls":>8} {"total":>10} {"self":>10} {"vertices":>10}')
+      for (calls, total, own, vertices), name in rows[:limit]:
+        lines.append(f'  {utils.shortenText(name, maxLength=46):<48} {calls:>8} '
+                     f'{total*1e3:>7.1f} ms {own*1e3:>7.1f} ms {vertices:>10}')
+      if len(rows) > limit:
+        lines.append(f'  ... {len(rows)-limit} more')
+      if not rows:
+        lines.append('  nothing evaluated, all results were taken from the cache')
+    return '\n'.join(lines)
+
+  def writeStacks(self, path):
+    # collapsed stacks with self times in microseconds, the input format
+    # of flamegraph.pl and speedscope
+    with open(path, 'w') as f:
+      for stack, seconds in sorted(self.stacks.items()):
+        f.write(f'{stack} {max(1, round(seconds*1e6))}\n')
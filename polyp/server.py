@@ -0,0 +1,176 @@
+import os as _os
+import io as _io
+import sys as _sys
+import json as _json
+import socket as _socket
+import tempfile as _tempfile
+import argparse as _argparse
+import traceback as _traceback
+import contextlib as _contextlib
+
+from . import utils
+from . import plsscript
+
+
+def socketPath(path=None):
+  if path:
+    return _os.path.abspath(path)
+  if _os.environ.get('POLYP_SOCKET'):
+    return _os.path.abspath(_os.environ['POLYP_SOCKET'])
+  if _os.environ.get('XDG_RUNTIME_DIR'):
+    return _os.path.join(_os.environ['XDG_RUNTIME_DIR'], 'polyp.sock')
+  return _os.path.join(_tempfile.gettempdir(), f'polyp-{_os.getuid()}.sock')
+
+
+def _send(conn, msg):
+  conn.sendall(_json.dumps(msg).encode()+b'\n')
+
+
+def _receive(conn):
+  data = b''
+  while not data.endswith(b'\n'):
+    chunk = conn.recv(64*1024)
+    if not chunk:
+      break
+    data += chunk
+  if not data.strip():
+    return None
+  return _json.loads(data)
+
+
+def request(msg, path=None, timeout=None):
+  # sends one request to a running server and returns its response
+  with _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM) as conn:
+    conn.settimeout(timeout)
+    conn.connect(socketPath(path))
+    _send(conn, msg)
+    return _receive(conn)
+
+
+class Server:
+  # renders scripts on request in a long running process, so that module
+  # imports and imported scripts stay loaded between requests. Requests
+  # are handled one after another and are json objects with an 'op':
+  #   cli:      run polyp with 'argv' in directory 'cwd'
+  #   render:   render the script at 'path' or the script 'text' and write
+  #             it to 'output', 'options' are passed to PlsScript
+  #   ping, shutdown
+  def __init__(self, path=None):
+    self.path = socketPath(path)
+    self.registry = plsscript.ImportRegistry()
+    self._running = False
+
+  def handle(self, msg):
+    op = msg.get('op')
+    if op == 'ping':
+      return {'returncode': 0}
+    if op == 'shutdown':
+      self._running = False
+      return {'returncode': 0}
+    if op not in ['cli', 'render']:
+      return {'returncode': 2, 'stderr': f'unknown request "{op}"\n'}
+
+    # imported scripts stay loaded, but every request is a new run
+    self.registry.begin()
+    stdout, stderr = _io.StringIO(), _io.StringIO()
+    response = {'returncode': 0}
+    cwd = _os.getcwd()
+    try:
+      with _contextlib.redirect_stdout(stdout), _contextlib.redirect_stderr(stderr):
+        _os.chdir(msg.get('cwd', cwd))
+        if op == 'cli':
+          self._cli(msg['argv'])
+        else:
+          response.update(self._render(msg))
+    except SystemExit as e:
+      response['returncode'] = e.code if type(e.code) is int else (0 if e.code is None else 1)
+    except Exception:
+      response['returncode'] = 1
+      stderr.write(_traceback.format_exc())
+    finally:
+      _os.chdir(cwd)
+      self.registry.prune()
+    response['stdout'] = stdout.getvalue()
+    response['stderr'] = stderr.getvalue()
+    return response
+
+  def _cli(self, argv):
+    from . import __main__
+    if any([a in ['-v', '--view', '-w', '--watch', 'serve', '--client'] for a in argv]):
+      raise ValueError('viewing, watching and serving are not supported by the server')
+    __main__.main(argv, registry=self.registry)
+
+  def _render(self, msg):
+    options = msg.get('options', {})
+    if 'path' in msg:
+      script = plsscript.PlsScript(open(msg['path'], 'r'), registry=self.registry,
+                                   **options)
+    else:
+      script = plsscript.PlsScript(msg['text'], registry=self.registry, **options)
+    if msg.get('output'):
+      script.writeResults(msg['output'], stream=msg.get('stream', False))
+    return {'cells': script.outputNames(),
+            'cache': script.cacheReport().toDict()}
+
+  def serve(self):
+    if _os.path.exists(self.path):
+      try:
+        request({'op': 'ping'}, self.path, timeout=1)
+        raise ValueError('a polyp server is already listening on '+self.path)
+      except (ConnectionError, FileNotFoundError, _socket.timeout):
+        _os.remove(self.path)
+
+    with _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM) as sock:
+      sock.bind(self.path)
+      _os.chmod(self.path, 0o600)
+      sock.listen()
+      self._running = True
+      try:
+        while self._running:
+          conn, _ = sock.accept()
+          with conn:
+            try:
+              msg = _receive(conn)
+              if msg is not None:
+                _send(conn, self.handle(msg))
+            except (ConnectionError, ValueError) as e:
+              utils.debug('dropped request: '+str(e))
+      finally:
+        _os.remove(self.path)
+
+
+def serveMain(argv):
+  parser = _argparse.ArgumentParser(prog='polyp serve',
+                                    description='Keep a polyp process running that '
+                                                'renders scripts on request')
+  parser.add_argument('--socket', default=None,
+                      help='path of the unix socket, defaults to $POLYP_SOCKET, '
+                           '$XDG_RUNTIME_DIR/polyp.sock or /tmp/polyp-<uid>.sock')
+  parser.add_argument('--stop', action='store_true',
+                      help='stop the running server')
+  args = parser.parse_args(argv)
+
+  if args.stop:
+    request({'op': 'shutdown'}, args.socket)
+    return
+  server = Server(args.socket)
+  print(f'polyp server listening on {server.path}')
+  try:
+    server.serve()
+  except KeyboardInterrupt:
+    pass
+
+
+def clientMain(argv, path=None):
+  # forwards the command line to a running server, renders in this
+  # process if no server is running, returns the exit code
+  try:
+    response = request({'op': 'cli', 'argv': argv, 'cwd': _os.getcwd()}, path)
+  except (ConnectionError, FileNotFoundError):
+    print('polyp: no server running, rendering locally', file=_sys.stderr)
+    from . import __main__
+    __main__.main(argv)
+    return 0
+  _sys.stdout.write(response.get('stdout', ''))
+  _sys.stderr.write(response.get('stderr', ''))
+  return response['returncode']
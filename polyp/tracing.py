@@ -0,0 +1,256 @@
+import os as _os
+import time as _time
+import functools as _functools
+import contextlib as _contextlib
+
+from . import utils
+from . import cache
+from . import geometry
+from . import calltree
+from . import plsscript
+
+# Tracing reports spans, i.e., named and timed parts of a build, to all
+# registered hooks. Spans are created for
+#   section   construction of a SYMBOL/LAYER/SHAPE/IMPORT/GLOBALS section
+#   function  evaluation of a built-in function or application of a
+#             function like grow or array to a shape
+#   shape     instantiation of a SHAPE definition
+#   boolean   union, subtraction and intersection of shapes
+#   parse     parsing of the text of a section or shape into a call tree
+#   import    loading of an imported script and use of its symbols
+#   cache     loading and storing of cache files
+#   write     writing of result files
+# The measured methods are only replaced while at least one hook is
+# registered, so there is no overhead otherwise. Spans are only created in
+# the current process, not in worker processes of parallel builds.
+
+_hooks = []
+_stack = []
+_patched = []
+
+# names of the functions applied with the '.' operator
+_FUNCTION_NAMES = {geometry.Translator: 'translate', geometry.Rotator: 'rotate',
+                   geometry.Scaler: 'scale', geometry.Mirrower: 'mirror',
+                   geometry.Grower: 'grow', geometry.Rounder: 'round',
+                   geometry.Arrayer: 'array', utils.Caller: 'call'}
+_APPLIED_NAMES = set(_FUNCTION_NAMES.values())
+
+
+class Span:
+  def __init__(self, kind, name, parent=None, attributes={}):
+    self.kind = kind
+    self.name = name
+    self.parent = parent
+    self.attributes = dict(attributes)
+    self.start = _time.perf_counter()
+    self.end = None
+
+  @property
+  def duration(self):
+    return (self.end or _time.perf_counter()) - self.start
+
+  def path(self):
+    # names of all enclosing spans, outermost first
+    span, names = self, []
+    while span is not None:
+      names.append(span.name)
+      span = span.parent
+    return names[::-1]
+
+
+class Hook:
+  # base class of tracing hooks, enter is called when a span starts and
+  # exit when it ends, also if it ended with an exception. Then, the
+  # attribute 'error' of the span is set.
+  def enter(self, span):
+    pass
+
+  def exit(self, span):
+    pass
+
+
+def addHook(hook):
+  if not _hooks:
+    _install()
+  _hooks.append(hook)
+
+
+def removeHook(hook):
+  _hooks.remove(hook)
+  if not _hooks:
+    _uninstall()
+
+
+def _begin(kind, name, attributes={}):
+  span = Span(kind, name, _stack[-1] if _stack else None, attributes)
+  _stack.append(span)
+  for hook in _hooks:
+    hook.enter(span)
+  return span
+
+
+def _finish(span, error=None):
+  span.end = _time.perf_counter()
+  if error is not None:
+    span.attributes['error'] = type(error).__name__
+  _stack.pop()
+  for hook in reversed(_hooks):
+    hook.exit(span)
+
+
+@_contextlib.contextmanager
+def span(kind, name, **attributes):
+  # creates a span around a block of code if any hook is registered,
+  # yields the span (or None) to add attributes
+  if not _hooks:
+    yield None
+    return
+  s = _begin(kind, name, attributes)
+  try:
+    yield s
+  except BaseException as e:
+    _finish(s, e)
+    raise
+  _finish(s)
+
+
+def vertexCount(obj):
+  if isinstance(obj, geometry.Shape):
+    obj = obj._shape
+  if hasattr(obj, 'polygons'):
+    return sum([len(p) for p in obj.polygons])
+  if hasattr(obj, 'points'):
+    return len(obj.points)
+  return 0
+
+
+def _literalVertices(literals):
+  return {'vertices': sum([vertexCount(l[1]) for l in literals or []
+                                if type(l) is list and len(l) > 1
+                                  and l[0] == 'shape'])}
+
+
+def _sectionName(section, root, head, text, prev, *args):
+  words = head.split()
+  name = ' '.join(words)
+  if words[0] == 'LAYER' and prev is not None:
+    symbol = prev._symbol or prev._symNamePattern
+    if symbol:
+      name = f'SYMBOL {symbol} {name}'
+  if root.path:
+    name = _os.path.basename(root.path)+':'+name
+  return name
+
+
+def _sectionAttributes(section, result, *args):
+  tree = getattr(section, '_callTree', None)
+  return _literalVertices([getattr(tree, '_result', None)])
+
+
+def _evaluateName(tree, *args, **kwargs):
+  # evaluating applied functions only creates them, they are traced when
+  # they are applied, shapes are traced when they are instantiated
+  if (not tree._func or tree._func in _APPLIED_NAMES
+        or tree._func in tree._root.shapeDict
+        or any([tree._func in lib.shapeDict
+                    for lib in tree._root.importDict.values()])):
+    return None
+  return tree._func
+
+
+def _parseName(*args, **kwargs):
+  # parsing is recursive, only the outermost call is traced
+  return None if _stack and _stack[-1].kind == 'parse' else 'parse'
+
+
+def _treeParseName(tree, root, text=''):
+  return _parseName() if text else None
+
+
+def _instantiateName(tree, obj, *args):
+  return obj.get('name', 'shape')
+
+
+def _applyName(check, lit):
+  return _FUNCTION_NAMES.get(type(check._func), type(check._func).__name__)
+
+
+def _pathName(action):
+  return lambda obj, path, *args, **kwargs: action+' '+_os.path.basename(path)
+
+
+def _pathAttributes(obj, result, path, *args, **kwargs):
+  return {'path': path}
+
+
+def _noAttributes(*args, **kwargs):
+  return {}
+
+
+def _instrumentation():
+  # (class or module, method, kind, name, attributes) of all traced
+  # methods and functions. name returns the name of the span or None to
+  # not trace this call, attributes returns the attributes added after
+  # the call
+  return [(plsscript._ScriptSection, '__init__', 'section',
+              _sectionName, _sectionAttributes),
+          (calltree.CallTree, 'evaluate', 'function', _evaluateName,
+              lambda tree, result, *args, **kwargs:
+                                  _literalVertices(getattr(tree, '_literals', []))),
+          (utils.TypeCheck, '__call__', 'function', _applyName,
+              lambda check, result, *args: _literalVertices([result])),
+          (calltree.CallTree, '__init__', 'parse', _treeParseName, _noAttributes),
+          (calltree.CallTree, 'createLiterals', 'parse', _parseName, _noAttributes),
+          (calltree.CallTree, '_instanciateShape', 'shape', _instantiateName,
+              lambda tree, result, *args: {'vertices': vertexCount(result)}),
+          (geometry.Shape, 'union', 'boolean', lambda shape, op: 'union',
+              lambda shape, result, op: {'vertices': vertexCount(result)}),
+          (geometry, 'unionAll', 'boolean', lambda shapes: 'union',
+              lambda shapes, result: {'vertices': vertexCount(result)}),
+          (geometry.Shape, 'substract', 'boolean', lambda shape, op: 'subtract',
+              lambda shape, result, op: {'vertices': vertexCount(result)}),
+          (geometry.Shape, 'intersect', 'boolean', lambda shape, op: 'intersect',
+              lambda shape, result, op: {'vertices': vertexCount(result)}),
+          (plsscript.ImportRegistry, 'load', 'import', _pathName('import'),
+              _pathAttributes),
+          (plsscript.PlsScript, 'importSymbols', 'import',
+              lambda script, lib, *args, **kwargs: 'import symbols', _noAttributes),
+          (plsscript, '_remapElements', 'import', lambda cell, layerMap: 'remap layers',
+              _noAttributes),
+          (cache.CacheStore, 'load', 'cache', _pathName('load'),
+              lambda store, result, path, *args: {'path': path,
+                                                  'hit': result is not None}),
+          (cache.CacheStore, 'store', 'cache', _pathName('store'), _pathAttributes),
+          (plsscript.PlsScript, 'writeResults', 'write', _pathName('write'),
+              _pathAttributes)]
+
+
+def _traced(original, kind, name, attributes):
+  @_functools.wraps(original)
+  def wrapper(obj, *args, **kwargs):
+    spanName = name(obj, *args, **kwargs)
+    if spanName is None:
+      return original(obj, *args, **kwargs)
+    s = _begin(kind, spanName)
+    try:
+      result = original(obj, *args, **kwargs)
+    except BaseException as e:
+      _finish(s, e)
+      raise
+    s.attributes.update(attributes(obj, result, *args, **kwargs))
+    _finish(s)
+    return result
+  return wrapper
+
+
+def _install():
+  for cls, attr, kind, name, attributes in _instrumentation():
+    original = getattr(cls, attr)
+    setattr(cls, attr, _traced(original, kind, name, attributes))
+    _patched.append((cls, attr, original))
+
+
+def _uninstall():
+  while _patched:
+    cls, attr, original = _patched.pop()
+    setattr(cls, attr, original)
@@ -1,15 +1,29 @@
 import re as _re
 import copy as _copy
 import os as _os
+import sys as _sys
+import time as _time
 import math as _math
+import itertools as _itertools
 import threading as _threading
+import collections.abc as _abc
+import numpy as _np
+import gdspy as _gdspy
 
 from . import geometry as _geometry
 
 
 def debug(*msg):
-  #print('DEBUG: '+' '.join([str(m) for m in msg]))
-  pass
+  if _os.environ.get('POLYP_DEBUG'):
+    print('DEBUG: '+' '.join([str(m) for m in msg]))
+
+
+def readScript(f):
+  text = ''
+  for line in f:
+    if not _re.match(r"\s*#", line):
+      text += line + "\n"
+  return text
 
 
 def shortenText(t, maxLength=30):
@@ -24,6 +38,61 @@ def testValidName(n):
     raise ValueError("Names must only contain non alphanumeric characters and underscores: '"+n+"'")
 
 
+class LazyDict(_abc.MutableMapping):
+  # dict whose values can be given as factories that are only called
+  # when the value is accessed for the first time, an optional tag
+  # remembers where a lazily added value came from
+  class _Lazy:
+    __slots__ = ['factory']
+    def __init__(self, factory):
+      self.factory = factory
+
+  def __init__(self, *args, **dargs):
+    self._data = dict(*args, **dargs)
+    self._tags = {}
+
+  def setLazy(self, key, factory, tag=None):
+    self._data[key] = LazyDict._Lazy(factory)
+    self._tags.pop(key, None)
+    if tag is not None:
+      self._tags[key] = tag
+
+  def isLoaded(self, key):
+    return type(self._data[key]) is not LazyDict._Lazy
+
+  def tag(self, key):
+    return self._tags.get(key)
+
+  def sortKeys(self):
+    self._data = dict(sorted(self._data.items(), key=lambda e: e[0]))
+
+  def __getitem__(self, key):
+    value = self._data[key]
+    if type(value) is LazyDict._Lazy:
+      value = self._data[key] = value.factory()
+    return value
+
+  def __setitem__(self, key, value):
+    self._data[key] = value
+    self._tags.pop(key, None)
+
+  def __delitem__(self, key):
+    del self._data[key]
+    self._tags.pop(key, None)
+
+  def __contains__(self, key):
+    return key in self._data
+
+  def __iter__(self):
+    return iter(self._data)
+
+  def __len__(self):
+    return len(self._data)
+
+  def __repr__(self):
+    return '<polyp.utils.LazyDict: '+', '.join([repr(k) for k in self._data])+'>'
+
+
 def makeLiteral(val):
   if type(val) is float:
     return ['float', val]
@@ -39,6 +108,32 @@ def makeLiteral(val):
     raise ValueError("Invalid type for literal conversion: {} ('{}')".format(type(val), val))
 
 
+def symbolInstanceName(pattern, params):
+  # name of the instance of a parametric symbol with the name pattern for
+  # the parameter literals params
+  def removeLitTypes(params):
+    res = []
+    for p in params:
+      if p[0] == 'obj':
+        res.append('_'.join([f'{k}{v[1]}' for k, v in p[1].items()]))
+      else:
+        res.append(p[1])
+    return res
+
+  # format and clean symbol name
+  name = (_re.sub(r'[^a-zA-Z0-9\._]+', ' ', pattern.format(*removeLitTypes(params)))
+            .strip().replace(' ', '_'))
+
+  # check if different than pattern to validate that placeholders
+  # existed in the original name
+  if pattern == name:
+    raise ValueError(f'parametric symbol name {pattern} does not '
+                      'seem to contain {} placeholders, please '
+                     f'insert placeholders to guarantee unique '
+                     f'symbol names for each parameter choice')
+  return name
+
+
 class TypeCheck:
   def __init__(self, typesIn, returnType=None):
     if type(typesIn) is list:
@@ -77,46 +172,13 @@ class TypeCheck:
 class Caller:
   def __init__(self, root, **dargs):
     self._root = root
-    self._arglist = []
+    self._dargs = dargs
     self._letters = ['a','b','c','d','e','f','g','h','i','j','k','l','m','n','o','p','q','r','s','t','u','v','w','x','y','z']
 
-    if 'start' in dargs and 'step' in dargs and 'stop' in dargs and len(dargs) == 3:
-      if type(dargs['start']) is list:
-        currentArglist = _copy.deepcopy(dargs['start'])
-        while True:
-          self._arglist.append(_copy.deepcopy(currentArglist))
-          if not self._isNum(currentArglist[0][1]):
-            currentArglist[0][1] = self._letters[int(_math.ceil(self._toNum(currentArglist[0][1]) + dargs['step'][0][1]))]
-          else:
-            currentArglist[0][1] += dargs['step'][0][1]
-          dim = 0
-          while True:
-            if self._toNum(currentArglist[dim][1]) > self._toNum(dargs['stop'][dim][1]) or dargs['step'][dim][1] < 1e-5:
-              currentArglist[dim][1] = dargs['start'][dim][1]
-              dim += 1
-              if dim < len(currentArglist):
-                if not self._isNum(currentArglist[dim][1]):
-                  currentArglist[dim][1] = self._letters[
-                                    int(_math.ceil(self._toNum(currentArglist[dim][1]) + dargs['step'][dim][1]))]
-                else:
-                  currentArglist[dim][1] += dargs['step'][dim][1]
-              else:
-                break
-            else:
-              break
-
-          if not dim < len(currentArglist):
-            break
-      else:
-        currentArglist = [makeLiteral(dargs['start'])]
-        while True:
-          self._arglist.append(currentArglist)
-          currentArglist = [[currentArglist[0][0], currentArglist[0][1] + dargs['step']]]
-          if currentArglist[0][1] > dargs['stop']:
-            break
-
-    elif len(dargs) > 0:
-      raise ValueError("Invalid arguments in parametric function call, expect 'start', 'step' and 'stop'.")
+    self._ref = bool(dargs.pop('ref', False))
+    if len(dargs) > 0 and not ('start' in dargs and 'step' in dargs
+                               and 'stop' in dargs and len(dargs) == 3):
+      raise ValueError("Invalid arguments in parametric function call, expect 'start', 'step', 'stop' and optionally 'ref'.")
 
   def _isNum(self, v):
     return type(v) is float or type(v) is int
@@ -127,23 +189,225 @@ class Caller:
     else:
       return v
 
+  def argsets(self):
+    # generates the argument sets of the sweep, the first parameter
+    # changes fastest, parameters with a step below 1e-5 stay constant
+    dargs = self._dargs
+    if not dargs:
+      return
+    if type(dargs['start']) is list:
+      currentArglist = [list(arg) for arg in dargs['start']]
+      while True:
+        yield [list(arg) for arg in currentArglist]
+        if not self._isNum(currentArglist[0][1]):
+          currentArglist[0][1] = self._letters[int(_math.ceil(self._toNum(currentArglist[0][1]) + dargs['step'][0][1]))]
+        else:
+          currentArglist[0][1] += dargs['step'][0][1]
+        dim = 0
+        while True:
+          if self._toNum(currentArglist[dim][1]) > self._toNum(dargs['stop'][dim][1]) or dargs['step'][dim][1] < 1e-5:
+            currentArglist[dim][1] = dargs['start'][dim][1]
+            dim += 1
+            if dim < len(currentArglist):
+              if not self._isNum(currentArglist[dim][1]):
+                currentArglist[dim][1] = self._letters[
+                                  int(_math.ceil(self._toNum(currentArglist[dim][1]) + dargs['step'][dim][1]))]
+              else:
+                currentArglist[dim][1] += dargs['step'][dim][1]
+            else:
+              break
+          else:
+            break
+
+        if not dim < len(currentArglist):
+          break
+    else:
+      currentArglist = [makeLiteral(dargs['start'])]
+      while True:
+        yield currentArglist
+        currentArglist = [[currentArglist[0][0], currentArglist[0][1] + dargs['step']]]
+        if currentArglist[0][1] > dargs['stop']:
+          break
+
+  def count(self):
+    # number of argument sets generated by argsets, the product of the
+    # number of values of each parameter
+    dargs = self._dargs
+    if not dargs:
+      return 0
+    if type(dargs['start']) is list:
+      total = 1
+      for start, step, stop in zip(dargs['start'], dargs['step'], dargs['stop']):
+        total *= self._valueCount(start[1], step[1], stop[1], True)
+      return total
+    return self._valueCount(makeLiteral(dargs['start'])[1], dargs['step'], dargs['stop'], False)
+
+  def _valueCount(self, start, step, stop, constant):
+    # the values are accumulated like in argsets to get the same rounding
+    count, value = 1, start
+    while True:
+      if not self._isNum(value):
+        value = self._letters[int(_math.ceil(self._toNum(value) + step))]
+      else:
+        value += step
+      if self._toNum(value) > self._toNum(stop) or constant and step < 1e-5:
+        return count
+      count += 1
 
   def __call__(self, obj):
+    if self._ref:
+      return self._references(obj)
     if type(obj) is str:
       obj = self._root.shapeDict[obj]
-    args = obj['args']
-    union = _geometry.Shape()
+    total = self.count()
+    progress = Progress('sweep of '+obj.get('name', 'shape'), total)
+
+    # large sweeps are evaluated in worker processes if the script is
+    # rendered with several jobs, otherwise the shapes of each chunk of
+    # argument sets are united before the next chunk is evaluated
+    jobs = getattr(self._root, 'jobs', 1)
+    if jobs > 1 and total >= _PARALLEL_SWEEP_SIZE and obj['tree']._root.path:
+      shapes = self._root.evaluateSweep(obj, self.argsets(), total, jobs, progress)
+    else:
+      shapes = []
+      chunk = []
+      for shape in sweepShapes(obj, self.argsets()):
+        chunk.append(shape)
+        progress.update(1)
+        if len(chunk) == _SWEEP_CHUNK_SIZE:
+          shapes.append(_geometry.unionAll(chunk))
+          chunk = []
+      shapes += chunk
+    progress.close()
+
+    return ['shape', _geometry.unionAll(shapes)]
+
+
+  def _references(self, name):
+    # references to instances of the parametric symbol name, instances
+    # that only differ by a translation share the cell of the first one
+    if type(name) is not str or name in self._root.shapeDict:
+      raise ValueError("Sweeps with 'ref=True' require a parametric symbol.")
+    paramSym = self._root.paramSymbol(name)
+    pattern = paramSym[0]['name_pattern']
+    argNames = paramSym[0]['args']
+    lib = self._root.gdsLib
+    precision = lib.precision/lib.unit
 
-    for argset in self._arglist:
-      tree = _copy.deepcopy(obj['tree'])
+    progress = Progress('sweep of '+pattern, self.count())
+    cells = {}
+    refs = []
+    for argset in self.argsets():
+      if len(argset) != len(argNames):
+        raise ValueError(f"Sweep of parametric symbol {pattern} needs "
+                         f"{len(argNames)} parameters, found {len(argset)}.")
+      symName = symbolInstanceName(pattern, argset)
+      if symName in lib.cells and len(list(lib.cells[symName])) > 0:
+        refs.append(['shaperef', _gdspy.CellReference(lib.cells[symName])])
+      else:
+        elements = self._root.paramSymbolElements(paramSym, dict(zip(argNames, argset)))
+        key, corner = _translationKey(elements, precision)
+        if key in cells:
+          sym, origin = cells[key]
+          refs.append(['shaperef', _gdspy.CellReference(sym, tuple((corner-origin).tolist()))])
+        else:
+          sym = _gdspy.Cell(symName, exclude_from_current=True)
+          self._root.addParamSymbolCell(sym, elements, pattern)
+          cells[key] = (sym, corner)
+          refs.append(['shaperef', _gdspy.CellReference(sym)])
+      progress.update(1)
+    progress.close()
+    return refs
+
+
+def _translationKey(elements, precision):
+  # key of the shapes and references of a parametric symbol instance that
+  # does not change if all of them are translated, and the corner they
+  # are given relative to, coordinates are compared with precision
+  shapes, refs = elements
+  points = [p for _, shape, _ in shapes for p in shape.polygons]
+  points += [_np.array([ref.origin]) for ref in refs]
+  corner = (_np.min(_np.concatenate(points), axis=0) if points
+              else _np.zeros(2))
+  def rounded(p):
+    return _np.round((_np.array(p) - corner)/precision).astype(_np.int64).tobytes()
+
+  key = [(layer, tuple(shape.layers), tuple(shape.datatypes),
+          tuple([rounded(p) for p in shape.polygons]))
+            for layer, shape, _ in shapes]
+  key += [(type(ref).__name__, getattr(ref.ref_cell, 'name', ref.ref_cell),
+           rounded(ref.origin), ref.rotation, ref.magnification, ref.x_reflection,
+           getattr(ref, 'columns', None), getattr(ref, 'rows', None),
+           tuple(getattr(ref, 'spacing', ())))
+            for ref in refs]
+  return tuple(key), corner
+
+
+# minimal number of argument sets of a sweep evaluated in parallel
+_PARALLEL_SWEEP_SIZE = 256
+# number of argument sets of a sweep held in memory at once
+_SWEEP_CHUNK_SIZE = 1000
+
+
+def chunks(iterable, size):
+  # generates lists of up to size consecutive items of iterable
+  iterator = iter(iterable)
+  while True:
+    chunk = list(_itertools.islice(iterator, size))
+    if not chunk:
+      return
+    yield chunk
+
+
+def sweepShapes(obj, argsets):
+  # generates the shape obj instantiated with each of the argument sets,
+  # the numeric parts of the shape are evaluated for a chunk of argument
+  # sets at once before, see CallTree.vectorize
+  args = obj['args']
+  for chunk in chunks(argsets, _SWEEP_CHUNK_SIZE):
+    for argset in chunk:
       if len(argset) > len(args):
         raise ValueError("More sweep parameters than shape parameters.")
+      if len(argset) != len(args):
+        raise ValueError("Unresolved names in parametric function call.")
+    template, plan = obj['tree'].vectorize(args, chunk)
+    for i, argset in enumerate(chunk):
+      tree = _copy.deepcopy(template)
+      tree.fillVectorized(plan, i)
       tree.resolveNames({k: v for k, v in zip(args, argset)})
+      tree.evaluate()
+      yield tree.getShape()
 
-      if len(self._arglist[0]) == len(args):
-        tree.evaluate()
-        union.union(tree.getShape())
-      else:
-        raise ValueError("Unresolved names in parametric function call.")
 
-    return ['shape', union]
+class Progress:
+  # prints the progress of a long operation to stderr, once it took more
+  # than delay seconds, on terminals the line is updated in place
+  def __init__(self, name, total, delay=2., interval=None):
+    self.name = name
+    self.total = total
+    self.done = 0
+    self._tty = _sys.stderr.isatty()
+    self._interval = interval or (.2 if self._tty else 10.)
+    self._started = _time.perf_counter()
+    self._next = self._started + delay
+    self._printed = False
+
+  def update(self, n):
+    self.done += n
+    if _time.perf_counter() >= self._next:
+      self._print()
+
+  def _print(self):
+    elapsed = _time.perf_counter() - self._started
+    _sys.stderr.write(f'{chr(13) if self._tty else ""} > {self.name}: {self.done}/{self.total} '
+                      f'({100*self.done/max(1, self.total):.0f}%, {elapsed:.0f} s)'
+                      + ('' if self._tty else '\n'))
+    _sys.stderr.flush()
+    self._printed = True
+    self._next = _time.perf_counter() + self._interval
+
+  def close(self):
+    if self._printed:
+      self._print()
+      if self._tty:
+        _sys.stderr.write('\n')
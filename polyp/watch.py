@@ -0,0 +1,149 @@
+import os as _os
+import sys as _sys
+import time as _time
+import struct as _struct
+import select as _select
+import ctypes as _ctypes
+import ctypes.util as _ctypesUtil
+
+from . import utils
+
+# inotify constants, see <sys/inotify.h>
+_IN_MODIFY = 0x2
+_IN_ATTRIB = 0x4
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_EVENT = _struct.Struct('iIII')
+
+
+class _Inotify:
+  # watches the directories of the files, so that files replaced by
+  # editors (write to temporary file and rename) are noticed as well
+  def __init__(self):
+    libc = _ctypes.CDLL(_ctypesUtil.find_library('c'), use_errno=True)
+    self._addWatch = libc.inotify_add_watch
+    self._addWatch.argtypes = [_ctypes.c_int, _ctypes.c_char_p, _ctypes.c_uint32]
+    self._rmWatch = libc.inotify_rm_watch
+    self._rmWatch.argtypes = [_ctypes.c_int, _ctypes.c_int]
+    self._fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    if self._fd < 0:
+      raise OSError(_ctypes.get_errno(), 'inotify_init1 failed')
+    self._dirs = {}
+    self._paths = set()
+
+  def setPaths(self, paths):
+    self._paths = set(paths)
+    dirs = set([_os.path.dirname(p) for p in self._paths])
+    for d in list(self._dirs):
+      if d not in dirs:
+        self._rmWatch(self._fd, self._dirs.pop(d))
+    for d in dirs:
+      if d not in self._dirs:
+        wd = self._addWatch(self._fd, _os.fsencode(d),
+                            _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE
+                            | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE)
+        if wd < 0:
+          raise OSError(_ctypes.get_errno(), 'inotify_add_watch failed for '+d)
+        self._dirs[d] = wd
+
+  def poll(self, timeout):
+    # returns the changed paths, waits at most timeout seconds for events
+    if not _select.select([self._fd], [], [], timeout)[0]:
+      return set()
+    dirs = {wd: d for d, wd in self._dirs.items()}
+    changed = set()
+    try:
+      data = _os.read(self._fd, 64*1024)
+    except BlockingIOError:
+      return changed
+    pos = 0
+    while pos < len(data):
+      wd, _, _, length = _EVENT.unpack_from(data, pos)
+      name = data[pos+_EVENT.size:pos+_EVENT.size+length].rstrip(b'\0')
+      pos += _EVENT.size + length
+      if wd in dirs:
+        path = _os.path.join(dirs[wd], _os.fsdecode(name))
+        if path in self._paths:
+          changed.add(path)
+    return changed
+
+  def close(self):
+    _os.close(self._fd)
+
+
+class _Polling:
+  def __init__(self, interval=.1):
+    self._interval = interval
+    self._stats = {}
+
+  def _stat(self, path):
+    try:
+      st = _os.stat(path)
+      return (st.st_mtime_ns, st.st_size, st.st_ino)
+    except OSError:
+      return None
+
+  def setPaths(self, paths):
+    self._stats = {p: self._stats.get(p, self._stat(p)) for p in paths}
+
+  def poll(self, timeout):
+    deadline = _time.monotonic() + timeout
+    while True:
+      changed = set()
+      for path, st in self._stats.items():
+        newSt = self._stat(path)
+        if newSt != st:
+          self._stats[path] = newSt
+          changed.add(path)
+      remaining = deadline - _time.monotonic()
+      if changed or remaining <= 0:
+        return changed
+      _time.sleep(min(self._interval, remaining))
+
+  def close(self):
+    pass
+
+
+class Watcher:
+  # waits for changes of a set of files, uses inotify if available and
+  # polls modification times otherwise. Changes that follow each other
+  # within the debounce time are reported together.
+  def __init__(self, paths=[], debounce=.05, polling=False):
+    self.debounce = debounce
+    self._backend = None
+    if not polling and _sys.platform.startswith('linux'):
+      try:
+        self._backend = _Inotify()
+      except (OSError, AttributeError, TypeError):
+        utils.debug('inotify not available, polling files instead')
+    if self._backend is None:
+      self._backend = _Polling()
+    self.setPaths(paths)
+
+  def setPaths(self, paths):
+    self._backend.setPaths([_os.path.abspath(p) for p in paths])
+
+  def wait(self, timeout=None):
+    # returns the sorted list of changed paths, an empty list if nothing
+    # changed within timeout seconds
+    changed = self._backend.poll(1e9 if timeout is None else timeout)
+    while changed:
+      more = self._backend.poll(self.debounce)
+      if not more:
+        break
+      changed |= more
+    return sorted(changed)
+
+  def close(self):
+    self._backend.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
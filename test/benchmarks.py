@@ -0,0 +1,209 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import statistics
+import subprocess
+
+# Benchmarks of synthetic scripts that stress one feature of polyp each and
+# can be scaled to arbitrary size. Every scenario is rendered in a fresh
+# process, once without cache ('cold') and once from the cache of the
+# first run ('cached'), the time of the render and the peak memory of the
+# process are recorded. Run
+#   python test/benchmarks.py                      all scenarios, small sizes
+#   python test/benchmarks.py --full -o new.json   all sizes, write results
+#   python test/benchmarks.py --compare old.json   compare to earlier results
+
+
+def plusChain(n):
+  # n rectangles joined with '+'
+  shapes = '\n    + '.join([f'rect(1).translate({2*i}, 0)' for i in range(n)])
+  return {'main.pls': f'SYMBOL main\n  LAYER 1\n    {shapes}\n'}
+
+
+def largeArray(n):
+  # n x n array of rotated rectangles
+  return {'main.pls': 'SYMBOL main\n'
+                      '  LAYER 1\n'
+                      f'    rect(1).rotate(30).array({n}, {n}, 2, 2)\n'}
+
+
+def nestedShapes(n):
+  # chain of n shapes, each one calling the previous one
+  lines = ['SHAPE s0(x)', '  rect(x)']
+  for i in range(1, n):
+    lines += [f'SHAPE s{i}(x)', f'  s{i-1}(x) + rect(x/2).translate({i}*x, 0)']
+  lines += ['SYMBOL main', '  LAYER 1', f'    s{n-1}(1)']
+  return {'main.pls': '\n'.join(lines)+'\n'}
+
+
+def paramSymbols(n):
+  # n instances of a parametric symbol, each with another parameter
+  lines = ['SYMBOL cell{:04.0f} (i)', '  LAYER 1', '    rect(1+i/10, 1).grow(0.1)',
+           'SYMBOL main']
+  lines += [f'  ref(cell, {i}).translate(0, {3*i})' for i in range(n)]
+  return {'main.pls': '\n'.join(lines)+'\n'}
+
+
+def callSweep(n):
+  # one shape called with n argument sets
+  return {'main.pls': 'SHAPE dot(s, x)\n'
+                      '  rect(s).translate(x, 0)\n'
+                      'SYMBOL main\n'
+                      '  LAYER 1\n'
+                      f'    dot.call(start=(1, 0), step=(0, 2), stop=(1, {2*(n-1)}))\n'}
+
+
+def textLayer(n):
+  # n lines of text on one layer
+  lines = '\n    + '.join([f"text('line {i} of benchmark text', dy=1)"
+                                f'.translate(0, {2*i})' for i in range(n)])
+  return {'main.pls': f'SYMBOL main\n  LAYER 1\n    {lines}\n'}
+
+
+def importTree(n):
+  # chain of n imported libraries, each one referencing a symbol of the
+  # next one
+  files = {}
+  for i in range(n):
+    lines = [f"IMPORT lib{i+1}.pls"] if i < n-1 else []
+    lines += [f'SYMBOL part{i}']
+    if i < n-1:
+      lines += [f'  ref(part{i+1}).translate(2, 0)']
+    lines += ['  LAYER 1', f'    rect(1).rotate({i})']
+    files[f'lib{i}.pls'] = '\n'.join(lines)+'\n'
+  files['main.pls'] = 'IMPORT lib0.pls\nSYMBOL main\n  ref(part0)\n'
+  return files
+
+
+# scenario: (generator, small sizes, full sizes)
+SCENARIOS = {'plusChain':    (plusChain,    [20],  [20, 100, 400]),
+             'largeArray':   (largeArray,   [10],  [10, 20, 40]),
+             'nestedShapes': (nestedShapes, [10],  [10, 40, 80]),
+             'paramSymbols': (paramSymbols, [10],  [10, 50, 200]),
+             'callSweep':    (callSweep,    [20],  [20, 200, 1000]),
+             'textLayer':    (textLayer,    [10],  [10, 50, 100]),
+             'importTree':   (importTree,   [3],   [3, 10, 30])}
+
+
+def writeScenario(name, size, directory):
+  # writes the files of a scenario to directory and returns the main file
+  for filename, text in SCENARIOS[name][0](size).items():
+    with open(os.path.join(directory, filename), 'w') as f:
+      f.write(text)
+  return os.path.join(directory, 'main.pls')
+
+
+def _child(path, forceRerender):
+  # renders one script in this process and prints time and peak memory
+  import polyp
+  started = time.perf_counter()
+  with open(path) as f:
+    script = polyp.plsscript.PlsScript(f, forceRerender)
+  script.writeResults(path[:-len('.pls')]+'.gds')
+  elapsed = time.perf_counter() - started
+  # ru_maxrss is given in kilobytes on linux and in bytes on macos
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  print(json.dumps({'time': elapsed,
+                    'peakRss': peak if sys.platform == 'darwin' else 1024*peak}))
+
+
+def runOnce(path, forceRerender=False):
+  res = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', path]
+                          + (['--force'] if forceRerender else []),
+                       cwd=os.path.dirname(path), capture_output=True, text=True)
+  if res.returncode != 0:
+    raise ValueError(f'rendering {path} failed:\n{res.stdout}{res.stderr}')
+  return json.loads(res.stdout.strip().split('\n')[-1])
+
+
+def runScenario(name, size, repeat=3):
+  # renders the scenario repeat times without and with cache, returns the
+  # results of both phases with median time and largest peak memory
+  results = {'cold': [], 'cached': []}
+  for _ in range(repeat):
+    with tempfile.TemporaryDirectory() as directory:
+      path = writeScenario(name, size, directory)
+      results['cold'].append(runOnce(path, forceRerender=True))
+      results['cached'].append(runOnce(path))
+  return [{'scenario': name, 'size': size, 'phase': phase,
+           'times': [r['time'] for r in runs],
+           'median': statistics.median([r['time'] for r in runs]),
+           'peakRss': max([r['peakRss'] for r in runs])}
+              for phase, runs in results.items()]
+
+
+def _gitCommit():
+  try:
+    res = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                         text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return res.stdout.strip() or None
+  except OSError:
+    return None
+
+
+def _key(result):
+  return (result['scenario'], result['size'], result['phase'])
+
+
+def formatHeader(compare=False):
+  return (f'{"scenario":<16} {"size":>6} {"phase":<7} {"time":>10} {"peak mem":>10}'
+            + (f' {"old time":>10} {"ratio":>7}' if compare else ''))
+
+
+def formatResult(result, old=None):
+  line = (f'{result["scenario"]:<16} {result["size"]:>6} {result["phase"]:<7} '
+          f'{result["median"]*1e3:>7.1f} ms {result["peakRss"]/2**20:>6.1f} MiB')
+  if old is not None:
+    line += f' {old["median"]*1e3:>7.1f} ms {result["median"]/old["median"]:>6.2f}x'
+  return line
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='benchmark polyp with synthetic scripts')
+  parser.add_argument('-s', '--scenario', action='append', choices=sorted(SCENARIOS),
+                      help='run only this scenario, may be given multiple times')
+  parser.add_argument('--full', action='store_true',
+                      help='run all sizes instead of only the smallest one')
+  parser.add_argument('--size', type=int, action='append',
+                      help='run this size instead of the predefined ones')
+  parser.add_argument('-r', '--repeat', type=int, default=3,
+                      help='number of runs per scenario and size, the median is reported')
+  parser.add_argument('-o', '--output', help='write results to this json file')
+  parser.add_argument('--compare', help='compare to results of an earlier run')
+  parser.add_argument('--child', help=argparse.SUPPRESS)
+  parser.add_argument('--force', action='store_true', help=argparse.SUPPRESS)
+  args = parser.parse_args(argv)
+
+  if args.child:
+    _child(args.child, args.force)
+    return 0
+
+  old = {}
+  if args.compare:
+    with open(args.compare) as f:
+      old = {_key(r): r for r in json.load(f)['results']}
+
+  print(formatHeader(bool(args.compare)), flush=True)
+  results = []
+  for name in args.scenario or SCENARIOS:
+    for size in args.size or SCENARIOS[name][2 if args.full else 1]:
+      for result in runScenario(name, size, args.repeat):
+        results.append(result)
+        print(formatResult(result, old.get(_key(result))), flush=True)
+
+  if args.output:
+    import polyp
+    with open(args.output, 'w') as f:
+      json.dump({'commit': _gitCommit(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                 'python': platform.python_version(), 'polyp': polyp.__version__,
+                 'platform': platform.platform(), 'results': results}, f, indent=2)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -2,6 +2,11 @@ import unittest
 import subprocess
 import os
 import time
+import shutil
+import tempfile
+import gdspy
+import polyp
+from unittest import mock
 
 class TestBuildExample(unittest.TestCase):
   def assertExists(self, path):
@@ -33,6 +38,640 @@ class TestBuildExample(unittest.TestCase):
     self.assertLess(time.time()-t0, .5*dt)
 
 
+  def test_cacheIgnoresTimestamps(self):
+    self._test_build(files=['caching'])
+    cached = {f: os.path.getmtime(f'test/pls/.{f}.plb')
+                                    for f in ['caching', 'expensive']}
+
+    # touching sources must not invalidate the cache
+    for f in cached:
+      os.utime(f'test/pls/{f}.pls')
+    self._test_build(files=['caching'], clean=False)
+    for f, mtime in cached.items():
+      self.assertEqual(os.path.getmtime(f'test/pls/.{f}.plb'), mtime)
+
+    # changing the content of a dependency must invalidate the cache
+    with open('test/pls/expensive.pls') as f:
+      original = f.read()
+    try:
+      with open('test/pls/expensive.pls', 'a') as f:
+        f.write('\nSHAPE unusedShape()\n  rect(1)\n')
+      self._test_build(files=['caching'], clean=False)
+      for f, mtime in cached.items():
+        self.assertNotEqual(os.path.getmtime(f'test/pls/.{f}.plb'), mtime)
+    finally:
+      with open('test/pls/expensive.pls', 'w') as f:
+        f.write(original)
+
+
+  def test_copiedCheckout(self):
+    # a cache hit loads the imports next to the script, not the imports of
+    # the checkout the cache file was written for
+    with tempfile.TemporaryDirectory() as d:
+      os.mkdir(os.path.join(d, 'a'))
+      with open(os.path.join(d, 'a', 'lib.pls'), 'w') as f:
+        f.write('SYMBOL libsym\n  LAYER 1\n    rect(2)\n')
+      with open(os.path.join(d, 'a', 'main.pls'), 'w') as f:
+        f.write('IMPORT lib.pls\nSYMBOL main\n  ref(libsym)\n')
+      for cacheDir in [None, os.path.join(d, 'cache')]:
+        polyp.plsscript.PlsScript(open(os.path.join(d, 'a', 'main.pls')),
+                                  cacheDir=cacheDir)
+        shutil.copytree(os.path.join(d, 'a'), os.path.join(d, 'b'))
+        with open(os.path.join(d, 'a', 'lib.pls'), 'w') as f:
+          f.write('SYMBOL libsym\n  LAYER 1\n    rect(7)\n')
+
+        script = polyp.plsscript.PlsScript(open(os.path.join(d, 'b', 'main.pls')),
+                                           cacheDir=cacheDir)
+        self.assertEqual(script._cacheReport['result'], 'hit')
+        self.assertEqual(script.importDict['lib'].path, os.path.join(d, 'b', 'lib.pls'))
+        self.assertEqual(script.gdsLib.cells['libsym'].area(), 4)
+
+        # cache files of other versions of the imports are not used
+        with open(os.path.join(d, 'b', 'lib.pls'), 'w') as f:
+          f.write('SYMBOL libsym\n  LAYER 1\n    rect(3)\n')
+        script = polyp.plsscript.PlsScript(open(os.path.join(d, 'b', 'main.pls')),
+                                           cacheDir=cacheDir)
+        self.assertEqual(script.gdsLib.cells['libsym'].area(), 9)
+        shutil.rmtree(os.path.join(d, 'b'))
+        with open(os.path.join(d, 'a', 'lib.pls'), 'w') as f:
+          f.write('SYMBOL libsym\n  LAYER 1\n    rect(2)\n')
+
+
+  def test_sectionCache(self):
+    script = ('SHAPE marker(s)\n  rect(s).rotate(45)\n'
+              'SYMBOL first\n  LAYER 1\n    marker(2).array(20, 20, 1, 1)\n'
+              'SYMBOL second\n  LAYER 2\n    text("second", dy=1)\n')
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'sections.pls')
+      with open(path, 'w') as f:
+        f.write(script)
+      polyp.plsscript.PlsScript(open(path))
+
+      # only the edited section must be evaluated again
+      with open(path, 'w') as f:
+        f.write(script.replace('"second"', '"edited"'))
+      s = polyp.plsscript.PlsScript(open(path))
+      self.assertEqual([sec._callTree is None for sec in s.sections],
+                       [False, False, True, False, False])
+
+      # editing a shape invalidates all sections using it
+      with open(path, 'w') as f:
+        f.write(script.replace('"second"', '"edited"')
+                      .replace('rotate(45)', 'rotate(30)'))
+      s = polyp.plsscript.PlsScript(open(path))
+      self.assertEqual([sec._callTree is None for sec in s.sections],
+                       [False, False, False, False, True])
+
+      # globals defined after the shapes using them are covered as well
+      script = ('SHAPE inner(x)\n  rect(x*w)\nSHAPE outer(x)\n  inner(x)\n'
+                'GLOBALS\n  w = 2\nSYMBOL main\n  LAYER 1\n    outer(3)\n')
+      for w, area in [(2, 36), (5, 225)]:
+        with open(path, 'w') as f:
+          f.write(script.replace('w = 2', f'w = {w}'))
+        s = polyp.plsscript.PlsScript(open(path))
+        self.assertEqual(s.gdsLib.cells['main'].area(), area)
+
+
+  def test_cacheFileFormat(self):
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'format.pls')
+      with open(path, 'w') as f:
+        f.write('GLOBALS\n  o = {\n    x = 1\n    y = 2\n  }\n  s = rect(3)\n  w = 2\n'
+                'SYMBOL main\n  LAYER 1\n    rect(w)\n')
+      script = polyp.plsscript.PlsScript(open(path))
+      script.gdsLib.cells['main'].add(gdspy.Label('pin', (1, 2), 'nw', layer=3))
+      script._storeCache()
+
+      # globals, cells and labels survive the json header
+      cached = polyp.plsscript.PlsScript(open(path))
+      self.assertEqual(cached._cacheReport['result'], 'hit')
+      self.assertEqual(cached.globals['w'], ['int', 2.])
+      self.assertEqual(cached.globals['o'], ['obj', {'x': ['int', 1.], 'y': ['int', 2.]}])
+      self.assertEqual(cached.globals['s'][1]._shape.area(), 9)
+      label, = cached.gdsLib.cells['main'].labels
+      self.assertEqual((label.text, tuple(label.position), label.anchor, label.layer),
+                       ('pin', (1, 2), gdspy.Label._anchor['nw'], 3))
+
+      # cache files cannot execute code, damaged files are rendered again
+      marker = os.path.join(d, 'executed')
+      payload = (b'cos\nsystem\n(S\'touch '+marker.encode()+b'\'\ntR.')
+      with open(cached._cachedPath, 'wb') as f:
+        f.write(b'POLYPLJ\n'+len(payload).to_bytes(8, 'little')+payload)
+      script = polyp.plsscript.PlsScript(open(path))
+      self.assertEqual(script._cacheReport['result'], 'error')
+      self.assertEqual(script.gdsLib.cells['main'].area(), 4)
+      self.assertFalse(os.path.exists(marker))
+      self.assertEqual(polyp.plsscript.PlsScript(open(path))._cacheReport['result'], 'hit')
+
+
+  def test_lazyImport(self):
+    with tempfile.TemporaryDirectory() as d:
+      with open(os.path.join(d, 'base.pls'), 'w') as f:
+        f.write('LAYER 1 metal\n'
+                'SYMBOL baseUsed\n  LAYER metal\n    rect(1)\n'
+                'SYMBOL baseUnused\n  LAYER metal\n    rect(2)\n')
+      with open(os.path.join(d, 'parts.pls'), 'w') as f:
+        f.write('LAYER 1 metal\nIMPORT base.pls\n'
+                'SYMBOL used\n  ref(baseUsed)\n  LAYER metal\n    rect(5)\n'
+                'SYMBOL unused\n  LAYER metal\n    rect(10)\n')
+      with open(os.path.join(d, 'chip.pls'), 'w') as f:
+        f.write('LAYER 3 metal\nIMPORT parts.pls\n'
+                'SYMBOL chip\n  ref(used)\n')
+      polyp.plsscript.PlsScript(open(os.path.join(d, 'chip.pls')))
+
+      # only cells that are referenced are unpacked from the cache
+      s = polyp.plsscript.PlsScript(open(os.path.join(d, 'chip.pls')))
+      self.assertEqual(s.sections, [])
+      self.assertFalse(s.gdsLib.cells.isLoaded('chip'))
+      s.gdsLib.cells['chip']
+      self.assertTrue(s.gdsLib.cells.isLoaded('used'))
+      self.assertFalse(s.gdsLib.cells.isLoaded('unused'))
+      self.assertFalse(s.importDict['parts'].gdsLib.cells.isLoaded('unused'))
+
+      # symbols of direct imports are written, unused cells of nested
+      # imports are not
+      s.writeResults(os.path.join(d, 'chip.gds'))
+      self.assertEqual(set(gdspy.GdsLibrary(infile=os.path.join(d, 'chip.gds')).cells),
+                       {'chip', 'used', 'unused', 'baseUsed', 'legend'})
+      self.assertFalse(s.gdsLib.cells.isLoaded('baseUnused'))
+
+      # streamed output is identical, without loading the cached cells
+      s = polyp.plsscript.PlsScript(open(os.path.join(d, 'chip.pls')))
+      s.writeResults(os.path.join(d, 'stream.gds'), stream=True)
+      self.assertFalse(any([s.gdsLib.cells.isLoaded(name) for name in s.gdsLib.cells]))
+      self.assertEqual(gdspy.GdsLibrary(infile=os.path.join(d, 'stream.gds'))
+                              .cells['used'].get_polygons(True).keys(),
+                       {(3, 0)})
+
+      # imported layers are mapped to the layers of the importing script
+      self.assertEqual(s.gdsLib.cells['unused'].get_polygons(True).keys(),
+                       {(3, 0)})
+      self.assertEqual(s.importDict['parts'].gdsLib.cells['unused']
+                                             .get_polygons(True).keys(),
+                       {(1, 0)})
+
+
+  def test_importOnlyOutput(self):
+    with tempfile.TemporaryDirectory() as d:
+      with open(os.path.join(d, 'parts.pls'), 'w') as f:
+        f.write('LAYER 1 metal\n'
+                'SYMBOL first\n  LAYER metal\n    rect(5)\n'
+                'SYMBOL second\n  LAYER metal\n    rect(10)\n')
+      with open(os.path.join(d, 'all.pls'), 'w') as f:
+        f.write('LAYER 3 metal\nIMPORT parts.pls\n')
+
+      # a script without symbols of its own writes all imported symbols,
+      # the generated legend does not count as a symbol
+      for _ in range(2):
+        s = polyp.plsscript.PlsScript(open(os.path.join(d, 'all.pls')))
+        s.writeResults(os.path.join(d, 'all.gds'))
+        self.assertEqual(set(gdspy.GdsLibrary(infile=os.path.join(d, 'all.gds')).cells),
+                         {'first', 'second', 'legend'})
+
+
+  def test_cacheReport(self):
+    with tempfile.TemporaryDirectory() as d:
+      lib, chip = os.path.join(d, 'parts.pls'), os.path.join(d, 'chip.pls')
+      with open(lib, 'w') as f:
+        f.write('SYMBOL part\n  LAYER 1\n    rect(5)\n')
+      with open(chip, 'w') as f:
+        f.write('IMPORT parts.pls\nSYMBOL chip\n  ref(part)\n')
+      polyp.plsscript.PlsScript(open(chip))
+
+      report = polyp.plsscript.PlsScript(open(chip)).cacheReport()
+      self.assertEqual([e['result'] for e in report.scripts], ['hit', 'hit'])
+
+      with open(lib, 'a') as f:
+        f.write('SYMBOL other\n  LAYER 1\n    rect(2)\n')
+      report = polyp.plsscript.PlsScript(open(chip)).cacheReport()
+      self.assertEqual([(e['script'], e['result'], e['reasons'])
+                                              for e in report.scripts],
+                       [(chip, 'miss', ['changed '+lib]),
+                        (lib, 'miss', ['changed '+lib])])
+      self.assertEqual(report.summary()['sectionHits'], 1)
+
+
+  def test_diamondDependencies(self):
+    with tempfile.TemporaryDirectory() as d:
+      files = {'common.pls': 'SYMBOL common\n  LAYER 1\n    rect(1)\n',
+               'a.pls': 'IMPORT common.pls\nSYMBOL a\n  ref(common)\n',
+               'b.pls': 'IMPORT common.pls\nSYMBOL b\n  ref(common)\n',
+               'main.pls': 'IMPORT a.pls\nIMPORT b.pls\nSYMBOL main\n  ref(a)\n'}
+      for name, text in files.items():
+        with open(os.path.join(d, name), 'w') as f:
+          f.write(text)
+
+      # every file is read once, imports are ordered before importers
+      with mock.patch('builtins.open', wraps=open) as opened:
+        graph = polyp.cache.DependencyGraph()
+        graph.key(os.path.join(d, 'main.pls'))
+      self.assertEqual(sorted([c.args[0] for c in opened.call_args_list]),
+                       sorted([os.path.join(d, name) for name in files]))
+      self.assertEqual([os.path.basename(p)
+                          for p in graph.order(os.path.join(d, 'main.pls'))],
+                       ['common.pls', 'a.pls', 'b.pls', 'main.pls'])
+
+      # a script imported along several paths is loaded only once
+      for _ in range(2):
+        s = polyp.plsscript.PlsScript(open(os.path.join(d, 'main.pls')))
+        self.assertIs(s.importDict['a'].importDict['common'],
+                      s.importDict['b'].importDict['common'])
+        self.assertEqual(len(s.cacheReport().scripts), 4)
+
+        # cells without remapped layers are not copied
+        self.assertIs(s.gdsLib.cells['common'],
+                      s.importDict['a'].importDict['common'].gdsLib.cells['common'])
+
+
+  def test_parallelImports(self):
+    with tempfile.TemporaryDirectory() as d:
+      for name in ['a', 'b']:
+        with open(os.path.join(d, name+'.pls'), 'w') as f:
+          f.write(f'SYMBOL {name}\n  LAYER 1\n    rect(5)\n')
+      with open(os.path.join(d, 'main.pls'), 'w') as f:
+        f.write('IMPORT a.pls\nIMPORT b.pls\nSYMBOL main\n  ref(a)\n  ref(b)\n')
+
+      # imports are rendered by workers and loaded from the cache
+      s = polyp.plsscript.PlsScript(open(os.path.join(d, 'main.pls')), jobs=2)
+      self.assertEqual(sorted([(os.path.basename(e['script']), e['result'])
+                                    for e in s.cacheReport().scripts]),
+                       [('a.pls', 'hit'), ('a.pls', 'miss'), ('b.pls', 'hit'),
+                        ('b.pls', 'miss'), ('main.pls', 'miss')])
+      self.assertEqual(len(s.gdsLib.cells['main'].get_dependencies(True)), 2)
+
+
+  def test_parallelSections(self):
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'sections.pls')
+      with open(path, 'w') as f:
+        f.write('SHAPE marker(s)\n  rect(s).rotate(45)\n'
+                'SYMBOL first\n  LAYER 1\n    marker(2).array(5, 5, 3, 3)\n'
+                '  LAYER 2\n    text("first", dy=1)\n'
+                'SYMBOL second\n  LAYER 1\n    marker(1)\n'
+                'SYMBOL top\n  ref(first)\n  ref(second)\n')
+
+      results = []
+      for jobs in [1, 2]:
+        s = polyp.plsscript.PlsScript(open(path), forceRerender=True, jobs=jobs)
+        results.append({name: sorted([(key, round(area, 6)) for key, area
+                                        in cell.area(True).items()])
+                            for name, cell in s.gdsLib.cells.items()})
+      self.assertEqual(results[0], results[1])
+      self.assertEqual(polyp.plsscript._independentSections(
+                          polyp.plsscript._splitSections(polyp.utils.readScript(open(path)))),
+                       [2, 3, 5])
+
+
+  def test_sweep(self):
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'sweep.pls')
+      with open(path, 'w') as f:
+        f.write('SHAPE dot(s, x, y)\n  rect(s).translate(x, y)\n'
+                'SYMBOL main\n  LAYER 1\n'
+                '    dot.call(start=(1, 0, 0), step=(0, 2, 3), stop=(1, 38, 42))\n')
+      caller = polyp.utils.Caller(None, start=[['int', 1], ['int', 0], ['string', 'a']],
+                                  step=[['int', 0], ['int', 1], ['int', 1]],
+                                  stop=[['int', 1], ['int', 1], ['string', 'c']])
+      self.assertEqual([[v for _, v in argset] for argset in caller.argsets()],
+                       [[1, 0, 'a'], [1, 1, 'a'], [1, 0, 'b'], [1, 1, 'b'],
+                        [1, 0, 'c'], [1, 1, 'c']])
+      self.assertEqual(caller.count(), 6)
+      # the size of a sweep is known without generating its argument sets
+      for dargs in [dict(start=[['float', -1.]], step=[['float', .1]], stop=[['float', 1.]]),
+                    dict(start=[['float', 0.], ['string', 'x']], step=[['float', .3], ['float', .5]],
+                         stop=[['float', 2.], ['string', 'y']]),
+                    dict(start=-1., step=.1, stop=1.)]:
+        caller = polyp.utils.Caller(None, **dargs)
+        self.assertEqual(caller.count(), len(list(caller.argsets())))
+
+      # 20 x 15 squares, evaluated in this process and in worker processes,
+      # in one and in several chunks of argument sets
+      chunkSize = polyp.utils._SWEEP_CHUNK_SIZE
+      try:
+        for polyp.utils._SWEEP_CHUNK_SIZE in [chunkSize, 7]:
+          for jobs in [1, 2]:
+            script = polyp.plsscript.PlsScript(open(path), True, jobs=jobs)
+            self.assertEqual(script.gdsLib.cells['main'].area(True), {(1, 0): 300})
+      finally:
+        polyp.utils._SWEEP_CHUNK_SIZE = chunkSize
+
+      # arguments of rect and translate are evaluated for all x at once
+      with open(path, 'w') as f:
+        f.write('SHAPE bar(x)\n  rect(1+abs(x)/2, sqrt(4)).translate(3*x, 0)\n'
+                'SYMBOL main\n  LAYER 1\n'
+                '    bar.call(start=(-4), step=(1), stop=(4))\n')
+      script = polyp.plsscript.PlsScript(open(path), True)
+      self.assertAlmostEqual(script.gdsLib.cells['main'].area(True)[(1, 0)], 38)
+      obj = script.shapeDict['bar']
+      _, plan = obj['tree'].vectorize(obj['args'], [[['int', float(x)]] for x in range(-4, 5)])
+      self.assertEqual([kind for _, kind, _ in plan], ['arguments', 'arguments'])
+
+
+  def test_sweepRefs(self):
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'refs.pls')
+      with open(path, 'w') as f:
+        f.write('SYMBOL dot{:.0f}_{:.0f} (x, y)\n  LAYER 1\n    rect(1+y).translate(3*x, 4*y)\n'
+                'SYMBOL main\n'
+                '  dot.call(start=(0, 0), step=(1, 1), stop=(9, 2), ref=True)\n')
+
+      # instances with the same y only differ by a translation
+      script = polyp.plsscript.PlsScript(open(path), True)
+      main = script.gdsLib.cells['main']
+      self.assertEqual(len(main.references), 30)
+      self.assertEqual(sorted(script.gdsLib.cells), ['dot0_0', 'dot0_1', 'dot0_2', 'main'])
+      self.assertAlmostEqual(main.area(True)[(1, 0)], 140)
+      self.assertEqual(tuple(main.references[9].origin), (27, 0))
+
+      # the references of a sweep cannot be transformed
+      with open(path, 'a') as f:
+        f.write('  dot.call(start=(0, 0), step=(1, 1), stop=(2, 0), ref=True).translate(100, 0)\n')
+      with self.assertRaises(ValueError):
+        polyp.plsscript.PlsScript(open(path), True)
+
+
+  def test_topCell(self):
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'variants.pls')
+      with open(path, 'w') as f:
+        f.write('SYMBOL variant_{} (n)\n  LAYER 1\n    rect(n)\n'
+                'SYMBOL a\n  LAYER 1\n    rect(1)\n'
+                'SYMBOL b\n  LAYER 1\n    rect(2)\n'
+                'SYMBOL top\n  ref(a)\n  ref(variant, 3)\n')
+
+      # only symbols used by the top cell are rendered and written
+      s = polyp.plsscript.PlsScript(open(path), top='top')
+      self.assertEqual([sec._callTree is not None for sec in s.sections],
+                       [True, True, True, True, False, False, True])
+      self.assertEqual(s.outputNames(), ['a', 'top', 'variant_3.0'])
+
+      s = polyp.plsscript.PlsScript(open(path), top='c')
+      with self.assertRaises(ValueError):
+        s.outputNames()
+
+
+  def test_watcher(self):
+    with tempfile.TemporaryDirectory() as d:
+      paths = [os.path.join(d, name) for name in ['main.pls', 'lib.pls', 'other.pls']]
+      for path in paths:
+        with open(path, 'w') as f:
+          f.write('')
+
+      for polling in [False, True]:
+        with polyp.watch.Watcher(paths[:2], polling=polling) as watcher:
+          self.assertEqual(watcher.wait(timeout=.1), [])
+
+          # files replaced by editors are noticed as well
+          with open(paths[1]+'.tmp', 'w') as f:
+            f.write('SYMBOL a\n')
+          os.replace(paths[1]+'.tmp', paths[1])
+          with open(paths[2], 'w') as f:
+            f.write('SYMBOL b\n')
+          self.assertEqual(watcher.wait(timeout=2), [paths[1]])
+
+  def test_profile(self):
+    evaluate = polyp.calltree.CallTree.evaluate
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'chip.pls')
+      with open(path, 'w') as f:
+        f.write('SYMBOL chip\n  LAYER 1\n    rect(5).grow(1) + rect(2).translate(9, 0)\n')
+      with polyp.profiling.Profiler() as profiler:
+        polyp.plsscript.PlsScript(open(path))
+      self.assertIs(polyp.calltree.CallTree.evaluate, evaluate)
+
+      calls = {name: stat[0] for (kind, name), stat in profiler.stats.items()
+                                    if kind in ['section', 'function', 'boolean']}
+      self.assertEqual(set(calls), {'chip.pls:SYMBOL chip', 'chip.pls:SYMBOL chip LAYER 1',
+                                    'rect', 'grow', 'translate', 'union'})
+      self.assertEqual([calls[name] for name in ['grow', 'translate', 'union']],
+                       [1, 1, 1])
+      self.assertEqual(profiler.stats[('section', 'chip.pls:SYMBOL chip LAYER 1')][3], 8)
+
+      profiler.writeStacks(os.path.join(d, 'chip.folded'))
+      with open(os.path.join(d, 'chip.folded')) as f:
+        stacks = [line.rsplit(' ', 1)[0] for line in f]
+      self.assertIn('chip.pls:SYMBOL chip LAYER 1;grow', stacks)
+
+
+  def test_memprofile(self):
+    import tracemalloc
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'chip.pls')
+      with open(path, 'w') as f:
+        f.write('SYMBOL chip\n  LAYER 1\n    rect(5).grow(1) + text("k", dy=2)\n')
+      with polyp.memprofile.MemoryProfiler() as profiler:
+        polyp.plsscript.PlsScript(open(path)).writeResults(os.path.join(d, 'chip.gds'))
+      self.assertFalse(tracemalloc.is_tracing())
+
+      self.assertGreater(profiler.sections['chip.pls:SYMBOL chip LAYER 1']['peak'], 0)
+      self.assertTrue({'parse', 'evaluate', 'geometry', 'cache', 'output'}
+                          <= set(profiler.subsystems))
+      self.assertGreaterEqual(profiler.peak, max([s['peak'] for s in
+                                                  profiler.subsystems.values()]))
+      self.assertIn('allocation sites', profiler.report())
+
+
+  def test_tracing(self):
+    class Recorder(polyp.tracing.Hook):
+      def __init__(self):
+        self.spans = []
+      def exit(self, span):
+        self.spans.append(span)
+
+    union = polyp.geometry.Shape.union
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'chip.pls')
+      with open(path, 'w') as f:
+        f.write('SHAPE marker(s)\n  rect(s) + rect(s/2).translate(s, 0)\n'
+                'SYMBOL chip\n  LAYER 1\n    marker(2)\n')
+      recorder = Recorder()
+      polyp.tracing.addHook(recorder)
+      try:
+        with polyp.tracing.span('build', 'chip', target='chip.gds') as span:
+          script = polyp.plsscript.PlsScript(open(path))
+          script.writeResults(os.path.join(d, 'chip.gds'))
+      finally:
+        polyp.tracing.removeHook(recorder)
+      self.assertIs(polyp.geometry.Shape.union, union)
+
+      spans = {(s.kind, s.name): s for s in recorder.spans}
+      self.assertEqual(recorder.spans[-1], span)
+      self.assertEqual(span.attributes, {'target': 'chip.gds'})
+      for key in [('section', 'chip.pls:SYMBOL chip LAYER 1'), ('shape', 'marker'),
+                  ('function', 'translate'), ('boolean', 'union'),
+                  ('cache', 'load .chip.plb'), ('cache', 'store .chip.plb'),
+                  ('write', 'write chip.gds')]:
+        self.assertIn(key, spans)
+        self.assertEqual(spans[key].path()[0], 'chip')
+      self.assertEqual(spans[('shape', 'marker')].parent.name,
+                       'chip.pls:SYMBOL chip LAYER 1')
+      self.assertEqual(spans[('shape', 'marker')].attributes['vertices'], 8)
+      self.assertFalse(spans[('cache', 'load .chip.plb')].attributes['hit'])
+
+
+  def test_complexityStats(self):
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'chip.pls')
+      with open(path, 'w') as f:
+        f.write('SHAPE marker(s)\n  rect(s).rotate(45)\n'
+                'SYMBOL pad\n  LAYER 1\n    rect(5)\n'
+                'SYMBOL chip\n  ref(pad)\n  LAYER 1\n    marker(2).array(2, 3, 10, 10)\n'
+                '  LAYER 2\n    rect(1)\n')
+
+      # geometry is attributed to its sections also if loaded from the cache
+      for _ in range(2):
+        script = polyp.plsscript.PlsScript(open(path))
+        stats = polyp.complexity.collect(script)
+        chip = stats['cells']['chip']
+        self.assertEqual({spec: (layer['polygons'], layer['vertices'])
+                              for spec, layer in chip['layers'].items()},
+                         {'1/0': (6, 24), '2/0': (1, 4)})
+        self.assertEqual(chip['references'], 1)
+        self.assertEqual([(s['source'], s['shapes'], s['vertices'])
+                              for s in chip['sources']],
+                         [('chip.pls:SYMBOL chip LAYER 1', ['marker'], 24),
+                          ('chip.pls:SYMBOL chip LAYER 2', [], 4)])
+        self.assertEqual(stats['shapes']['marker']['vertices'], 24)
+        self.assertEqual(stats['total']['vertices'], 32)
+
+      # the estimated gds size is close to the written file
+      script.writeResults(os.path.join(d, 'chip.gds'))
+      self.assertAlmostEqual(stats['total']['gdsBytes'],
+                             os.path.getsize(os.path.join(d, 'chip.gds')), delta=300)
+
+
+  def test_batchBuild(self):
+    with tempfile.TemporaryDirectory() as d:
+      os.mkdir(os.path.join(d, 'variants'))
+      with open(os.path.join(d, 'parts.pls'), 'w') as f:
+        f.write('SYMBOL part\n  LAYER 1\n    rect(5)\n')
+      for i in [3, 1, 2]:
+        with open(os.path.join(d, 'variants', f'v{i}.pls'), 'w') as f:
+          f.write(f'IMPORT ../parts.pls\nSYMBOL v{i}\n  ref(part).translate({i}, 0)\n')
+      with open(os.path.join(d, 'variants', 'broken.pls'), 'w') as f:
+        f.write('SYMBOL broken\n  LAYER 1\n    undefinedShape(1)\n')
+
+      targets = polyp.build.expandTargets([os.path.join(d, 'variants', 'v2.pls'),
+                                           os.path.join(d, 'variants')])
+      self.assertEqual([os.path.basename(t) for t in targets],
+                       ['v2.pls', 'broken.pls', 'v1.pls', 'v3.pls'])
+
+      # failed targets do not stop the others, results keep the target order
+      for jobs in [1, 2]:
+        results = polyp.build.build(targets, jobs=jobs, forceRerender=True)
+        self.assertEqual([t for t, _, _ in results], targets)
+        self.assertEqual([error is None for _, error, _ in results],
+                         [True, False, True, True])
+        for i in [1, 2, 3]:
+          self.assertExists(os.path.join(d, 'variants', f'v{i}.gds'))
+
+      # imports reused by a later target belong to that target
+      registry = polyp.plsscript.ImportRegistry()
+      options = {'forceRerender': True, 'cacheDir': None, 'cacheSize': None,
+                 'top': None, 'stream': False}
+      for i in [1, 2]:
+        path = os.path.join(d, 'variants', f'v{i}.pls')
+        self.assertIsNone(polyp.build._render((path, None, options, ()), registry)[0])
+        parts, = registry._scripts.values()
+        self.assertEqual(parts.parent.path, path)
+        self.assertEqual(parts._cacheReport['result'], ['forced', 'reused'][i-1])
+        self.assertTrue(any([e is parts._cacheReport
+                                for e in parts.parent._cacheStore.report.scripts]))
+
+      res = subprocess.run(['polyp', 'build', '-j', '2', 'variants'], cwd=d,
+                           capture_output=True, text=True)
+      self.assertEqual(res.returncode, 1)
+      self.assertIn('FAILED  variants/broken.pls', res.stdout)
+
+
+  def test_server(self):
+    import threading
+    with tempfile.TemporaryDirectory() as d:
+      for name in ['min.pls', 'lib.pls', 'nestedlib.pls']:
+        shutil.copy(f'test/pls/{name}', d)
+      with open(os.path.join(d, 'main.pls'), 'w') as f:
+        f.write('IMPORT lib.pls AS lib\n')
+
+      sock = os.path.join(d, 'polyp.sock')
+      server = polyp.server.Server(sock)
+      thr = threading.Thread(target=server.serve)
+      thr.start()
+      try:
+        for _ in range(100):
+          if os.path.exists(sock):
+            break
+          time.sleep(.05)
+
+        # imported scripts stay loaded between requests
+        res = polyp.server.request({'op': 'cli', 'argv': ['main.pls'], 'cwd': d}, sock)
+        self.assertEqual(res['returncode'], 0, res['stderr'])
+        self.assertExists(os.path.join(d, 'main.gds'))
+        lib = list(server.registry._scripts.values())
+        res = polyp.server.request({'op': 'render', 'path': 'main.pls',
+                                    'output': 'out.gds', 'cwd': d}, sock)
+        self.assertEqual(res['returncode'], 0, res['stderr'])
+        self.assertExists(os.path.join(d, 'out.gds'))
+        self.assertEqual(list(server.registry._scripts.values()), lib)
+        self.assertEqual([e['result'] for e in res['cache']['scripts']],
+                         ['hit', 'reused', 'reused'])
+
+        # forcing a rerender also rerenders scripts of earlier requests
+        res = polyp.server.request({'op': 'render', 'path': 'main.pls', 'cwd': d,
+                                    'options': {'forceRerender': True}}, sock)
+        self.assertEqual(res['returncode'], 0, res['stderr'])
+        self.assertEqual([e['result'] for e in res['cache']['scripts']], ['forced']*3)
+        self.assertNotIn(lib[0], server.registry._scripts.values())
+
+        # errors are reported to the client, the server keeps running
+        res = polyp.server.request({'op': 'cli', 'argv': ['missing.pls'], 'cwd': d}, sock)
+        self.assertNotEqual(res['returncode'], 0)
+        res = polyp.server.request({'op': 'render', 'path': 'min.pls', 'cwd': d}, sock)
+        self.assertEqual(res['returncode'], 0, res['stderr'])
+      finally:
+        polyp.server.request({'op': 'shutdown'}, sock)
+        thr.join()
+      self.assertFalse(os.path.exists(sock))
+
+
+  def test_centralCacheDir(self):
+    with tempfile.TemporaryDirectory() as d:
+      env = dict(os.environ, POLYP_CACHE_DIR=d)
+      for f in os.listdir('test/pls'):
+        if f.endswith('.plb'):
+          os.remove(os.path.join('test/pls', f))
+      res = subprocess.run(['polyp', 'caching.pls'], cwd='test/pls', env=env)
+      self.assertEqual(res.returncode, 0)
+      self.assertFalse(any([f.endswith('.plb') for f in os.listdir('test/pls')]))
+      self.assertEqual(len([f for f in os.listdir(d) if f.endswith('.plb')]), 4)
+
+      res = subprocess.run(['polyp', 'cache', 'stats'], env=env,
+                           capture_output=True)
+      self.assertEqual(res.returncode, 0)
+      self.assertIn('entries:   4', res.stdout.decode())
+
+      umask = os.umask(0)
+      os.umask(umask)
+      for f in os.listdir(d):
+        self.assertEqual(os.stat(os.path.join(d, f)).st_mode & 0o777, 0o666 & ~umask)
+
+      res = subprocess.run(['polyp', 'cache', 'prune', '--cache-size', '1'],
+                           env=env)
+      self.assertEqual(res.returncode, 0)
+      self.assertEqual(len(os.listdir(d)), 0)
+
+      # the budget is kept while writing, the latest file is never removed
+      res = subprocess.run(['polyp', 'caching.pls'], cwd='test/pls',
+                           env=dict(env, POLYP_CACHE_SIZE='1'))
+      self.assertEqual(res.returncode, 0)
+      self.assertEqual(len(os.listdir(d)), 1)
+      res = subprocess.run(['polyp', 'cache', 'clear'], env=env)
+
+      subprocess.run(['polyp', 'caching.pls'], cwd='test/pls', env=env)
+      res = subprocess.run(['polyp', 'cache', 'clear'], env=env)
+      self.assertEqual(res.returncode, 0)
+      self.assertEqual(len(os.listdir(d)), 0)
+
+
   def test_gdsBuild(self):
     self._test_build(files=['test', 'objects', 'qrcode', 'circles'])
 
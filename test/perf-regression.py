@@ -0,0 +1,220 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import unittest
+import gc
+import statistics
+import subprocess
+import warnings
+import tracemalloc
+import gdspy
+import polyp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchmarks
+
+# Compares render time and allocated memory of a set of scenarios to the
+# baselines stored in test/perf-baselines.json. Times are scaled with the
+# speed of this machine relative to the machine the baselines were taken
+# on, as measured by a fixed calibration workload. Environment variables:
+#   POLYP_PERF_UPDATE=1          measure and write new baselines instead
+#   POLYP_PERF_REPEAT=n          runs per scenario (default 7)
+#   POLYP_PERF_RETRIES=n         re-measurements of regressed scenarios (default 3)
+#   POLYP_PERF_THRESHOLD=x       allowed slowdown factor (default 2.0)
+#   POLYP_PERF_MEMORY_THRESHOLD  allowed memory growth factor (default 1.25)
+# A scenario regressed if its median and its fastest run are both slower
+# than the threshold allows, so that single runs disturbed by other
+# processes do not fail the test. Regressed scenarios are measured again
+# and the better result is kept, a real regression persists. Scenarios
+# may override the thresholds with 'threshold'/'memoryThreshold' entries
+# in the baseline file. The baselines record the last commit that
+# changed the polyp package, i.e. the code that was measured.
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'perf-baselines.json')
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pls')
+
+# name: example script of test/pls or (benchmark scenario, size)
+SCENARIOS = {'min': 'min.pls',
+             'circles': 'circles.pls',
+             'objects': 'objects.pls',
+             'qrcode': 'qrcode.pls',
+             'lib': 'lib.pls',
+             'plusChain': ('plusChain', 100),
+             'largeArray': ('largeArray', 10),
+             'nestedShapes': ('nestedShapes', 20),
+             'paramSymbols': ('paramSymbols', 30),
+             'callSweep': ('callSweep', 100),
+             'textLayer': ('textLayer', 20),
+             'importTree': ('importTree', 10)}
+
+# differences below this many seconds or bytes are never reported as
+# regressions, they are dominated by noise, e.g. the allocations of the
+# warning capture of pytest
+_MIN_DIFFERENCE = .005
+_MIN_MEMORY_DIFFERENCE = 256*1024
+
+
+def _setting(name, default):
+  return type(default)(os.environ.get(name, default))
+
+
+def calibrate(repeat=9):
+  # time of a fixed mix of python and gdspy work, used to translate the
+  # baseline times to the speed of the current machine. The fastest run
+  # is least disturbed by other processes.
+  times = []
+  for _ in range(repeat):
+    started = time.perf_counter()
+    for _ in range(5):
+      rects = [gdspy.Rectangle((i, 0), (i+1.5, 1+i%3)) for i in range(400)]
+      gdspy.boolean(rects, None, 'or')
+      sum([i*i%7 for i in range(200000)])
+    times.append(time.perf_counter() - started)
+  return min(times)
+
+
+def _prepare(scenario, directory):
+  # writes the files of a scenario to directory and returns its main file
+  if type(scenario) is str:
+    for f in os.listdir(EXAMPLES):
+      if f.endswith('.pls'):
+        shutil.copy(os.path.join(EXAMPLES, f), directory)
+    return os.path.join(directory, scenario)
+  return benchmarks.writeScenario(*scenario, directory)
+
+
+def _render(path):
+  with open(path) as f:
+    script = polyp.plsscript.PlsScript(f, True)
+  script.writeResults(path[:-len('.pls')]+'.gds')
+
+
+def measure(scenario, repeat=5):
+  # renders the scenario without cache repeat times after one warm-up run
+  # and once more while tracing allocations, returns the median and the
+  # fastest time and the peak of allocated memory
+  with tempfile.TemporaryDirectory() as d:
+    path = _prepare(scenario, d)
+    cwd = os.getcwd()
+    os.chdir(d)
+    try:
+      # warnings are recorded differently by each test runner
+      with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        _render(path)
+        times = []
+        for _ in range(repeat):
+          started = time.perf_counter()
+          _render(path)
+          times.append(time.perf_counter() - started)
+        gc.collect()
+        tracemalloc.start()
+        try:
+          _render(path)
+          memory = tracemalloc.get_traced_memory()[1]
+        finally:
+          tracemalloc.stop()
+    finally:
+      os.chdir(cwd)
+  return {'time': statistics.median(times), 'fastest': min(times), 'peakMemory': memory}
+
+
+def compare(baselines, results, calibration):
+  # returns the rows of the diff table and the names of all regressed
+  # scenarios
+  scale = calibration/baselines['calibration']
+  threshold = _setting('POLYP_PERF_THRESHOLD', 2.0)
+  memoryThreshold = _setting('POLYP_PERF_MEMORY_THRESHOLD', 1.25)
+  rows = [f'{"scenario":<14} {"old time":>10} {"new time":>10} {"ratio":>7} '
+          f'{"old mem":>9} {"new mem":>9} {"ratio":>7}',
+          f'(old times scaled by {scale:.2f} for the speed of this machine)']
+  regressions = []
+  for name, result in results.items():
+    old = baselines['scenarios'].get(name)
+    if old is None:
+      rows.append(f'{name:<14} {"-":>10} {result["time"]*1e3:>7.1f} ms {"new":>7}')
+      continue
+    oldTime = old['time']*scale
+    timeRatio = result['time']/oldTime
+    fastestRatio = result['fastest']/(old.get('fastest', old['time'])*scale)
+    memoryRatio = result['peakMemory']/max(1, old['peakMemory'])
+    failed = []
+    if (min(timeRatio, fastestRatio) > old.get('threshold', threshold)
+          and result['time'] - oldTime > _MIN_DIFFERENCE):
+      failed.append('time')
+    if (memoryRatio > old.get('memoryThreshold', memoryThreshold)
+          and result['peakMemory'] - old['peakMemory'] > _MIN_MEMORY_DIFFERENCE):
+      failed.append('memory')
+    if failed:
+      regressions.append(name)
+    rows.append(f'{name:<14} {oldTime*1e3:>7.1f} ms {result["time"]*1e3:>7.1f} ms '
+                f'{timeRatio:>6.2f}x {old["peakMemory"]/2**20:>5.1f} MiB '
+                f'{result["peakMemory"]/2**20:>5.1f} MiB {memoryRatio:>6.2f}x'
+                + (f'  REGRESSION ({", ".join(failed)})' if failed else ''))
+  return rows, regressions
+
+
+def _gitCommit():
+  # last commit of the polyp package, marked if it has local changes
+  package = os.path.dirname(os.path.abspath(polyp.__file__))
+  res = subprocess.run(['git', 'log', '-1', '--format=%h', '--', package],
+                       capture_output=True, text=True, cwd=package)
+  commit = res.stdout.strip() or None
+  if commit and subprocess.run(['git', 'diff', '--quiet', 'HEAD', '--', package],
+                               cwd=package).returncode:
+    commit += '-dirty'
+  return commit
+
+
+def writeBaselines(results, calibration, previous=None):
+  # keeps manually configured thresholds of previous baselines
+  scenarios = {}
+  for name, result in results.items():
+    old = (previous or {}).get('scenarios', {}).get(name, {})
+    scenarios[name] = {'time': round(result['time'], 6),
+                       'fastest': round(result['fastest'], 6),
+                       'peakMemory': result['peakMemory'],
+                       **{k: v for k, v in old.items()
+                              if k in ('threshold', 'memoryThreshold')}}
+  with open(BASELINES, 'w') as f:
+    json.dump({'commit': _gitCommit(), 'python': platform.python_version(),
+               'platform': platform.platform(), 'calibration': round(calibration, 6),
+               'scenarios': scenarios}, f, indent=2)
+    f.write('\n')
+
+
+class TestPerformance(unittest.TestCase):
+  def test_noRegression(self):
+    repeat = _setting('POLYP_PERF_REPEAT', 7)
+    calibration = calibrate()
+    results = {name: measure(scenario, repeat) for name, scenario in SCENARIOS.items()}
+
+    baselines = None
+    if os.path.exists(BASELINES):
+      with open(BASELINES) as f:
+        baselines = json.load(f)
+    if _setting('POLYP_PERF_UPDATE', 0) or baselines is None:
+      writeBaselines(results, calibration, baselines)
+      print(f'\nwrote baselines to {BASELINES}')
+      return
+
+    rows, regressions = compare(baselines, results, calibration)
+    for _ in range(_setting('POLYP_PERF_RETRIES', 3)):
+      if not regressions:
+        break
+      for name in regressions:
+        result = measure(SCENARIOS[name], repeat)
+        results[name] = {key: min(value, results[name][key])
+                              for key, value in result.items()}
+      rows, regressions = compare(baselines, results, calibration)
+    print('\n'+'\n'.join(rows))
+    if regressions:
+      self.fail(f'performance regression in {", ".join(regressions)}:\n'+'\n'.join(rows))
+
+
+if __name__ == '__main__':
+  unittest.main()